@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+"""
+here we have the acquisition pipeline without any Qt, for running sweeps from scripts, from the command line
+(headless.py) or on several instruments at once (multiInstrument.py)
+
+the loops that do the work are plain functions: stepSweep, stepSweepAdaptive and listSweep step the source,
+requestReadings keeps the worker busy with reading requests, collectReadings takes the readings off the done queue (or
+out of the ring buffer), readIVSweep gets an I vs V sweep and saveSweepExtras saves what goes next to the data. the
+gui's threads (sweepThread, measureThread, readRealTimeDataThread, ivDataThread and postProcessThread) are thin Qt
+wrappers around them, and the acquisition class runs them with plain threads and a recipe dict instead of the gui's
+widgets. start from defaultRecipe and change what you need:
+recipe = dict(defaultRecipe, mode='ivt', start=0.0, end=1.0, points=101, dt=0.05, outputDir='/data', name='cell1')
+k = gpib('GPIB0::24', useQueues=True, timeout=None) #useRing=True moves the readings through shared memory
+station = acquisition(k)
+station.setup(recipe) #what initialSetup and the gui's settings handlers send
+results = station.runRecipe(recipe) #all the sweeps the recipe asks for, saved as they go
+
+recipe keys:
+mode -- 'ivt' (I,V vs t, we step the source and read as fast as we can) or 'iv' (I vs V, the 2400 sweeps itself)
+source -- 'voltage' or 'current'
+start, end, points -- the sweep, in volts or amps
+dt -- seconds per sweep point (the most with autoAdvance)
+autoAdvance, minDwell -- I,V vs t: move on from each point once the reading has settled, but not before minDwell
+    seconds (see settling.py)
+samplesPerStep -- I,V vs t: 0 to pace the steps from here, more to have the 2400 step through the sweep from its
+    source list taking this many readings per step (a hardware timed sweep, see listSweep)
+nplc, average, compliance, autoZero, fourWire, rearTerminals -- measurement settings (compliance in A or V)
+burstReadings -- readings per buffered burst in I,V vs t mode, 0 for one per bus transaction
+area -- device area in cm^2 (a string, it goes in the file header as is)
+sweeps -- how many sweeps to do, back to back (continual mode)
+recovery -- seconds to wait between sweeps
+outputDir, name -- files go to <outputDir>/<name>_<unix time>.<format>
+format -- 'csv' or 'npy'
+session -- True saves all the sweeps into one session file (see sessionStore.py)
+"""
+import os
+import threading
+from collections import OrderedDict
+import numpy as np
+from binaryData import drainQueue, decodeBlocks, Empty
+from timing import deadlineScheduler, monotonic
+from dataWriters import openSweepFile, sweepFields, bufferedWriter
+from sessionStore import sessionWriter
+from ivAnalysis import sweepStats, transientStats, figuresOfMerit, saveFiguresOfMerit
+from settling import settlingDetector
+
+defaultRecipe = {'mode': 'ivt', 'source': 'voltage', 'start': 0.0, 'end': 1.0, 'points': 101, 'dt': 0.05,
+                 'nplc': 0.01, 'average': 0, 'compliance': 0.01, 'autoZero': False, 'fourWire': False,
+                 'rearTerminals': False, 'burstReadings': 0, 'area': '1', 'sweeps': 1, 'recovery': 0.0,
+                 'outputDir': '.', 'name': 'sweep', 'format': 'csv', 'session': False, 'autoAdvance': False,
+                 'minDwell': 0.05, 'samplesPerStep': 0}
+
+pipelineDepth = 5 #reading requests kept outstanding at the worker, enough that one is always waiting but few enough to stop quickly
+burstPipelineDepth = 2 #one burst waiting behind the one in progress, any more would hold up the source changes
+listLimit = 100 #the 2400's source list holds at most 100 points
+readingOverhead = 0.0005 #seconds the 2400 spends on each reading on top of its integration time (~2kHz into the buffer at 0.01 nplc)
+armTimerMin = 0.001 #the shortest interval the 2400's arm layer timer can be set to
+
+#settings every sweep needs whatever else it's set up for (binary transfers of time, voltage, current and status)
+instrumentDefaults = [':format:data sreal', ':system:beeper:state 0', ':sense:function:concurrent on',
+                      ':trace:feed:control never', ':sense:average:tcontrol repeat',
+                      ':format:elements time,voltage,current,status', ':trigger:delay 0',
+                      ':source:sweep:spacing linear', ':source:sweep:ranging best']
+
+#I,V vs t with a burst of readings per trigger going into the buffer, and back to one reading per trigger
+def burstCommands(burstReadings):
+    return [':trace:feed sense', ':trace:points {0:d}'.format(burstReadings), ':trigger:count {0:d}'.format(burstReadings)]
+burstOffCommands = [':trace:feed:control never', ':trigger:count 1']
+
+#runs one burst into the buffer and fetches it, send it as a 'query_raw' task (see gpib.py)
+burstQuery = ':trace:clear;:trace:feed:control next;:initiate;:trace:data?'
+
+stepHeader = 'Step times are in seconds from the start of the sweep\nSetpoint,Scheduled [s],Issued [s]'
+
+def _never():
+    return False
+
+#software paced I,V vs t sweep: each point goes out at its own absolute deadline dt after the one before, so timing
+#errors don't pile up over the sweep. returns the step log, the setpoint, scheduled and issued time of each step
+def stepSweep(q, points, dt, source, progress=None, stopped=_never):
+    q.put(('write',(':system:azero once',))) #autozero once before the sweep to prevent zero point drift
+    schedule = deadlineScheduler(dt)
+    schedule.start()
+    for i, point in enumerate(points):
+        schedule.waitFor(i)
+        if stopped():
+            break
+        q.put(('write',(':source:' + source + ' {0:.4f}'.format(point),)))
+        schedule.record(i, point)
+        if progress is not None:
+            progress(float(i)/len(points)*100)
+    else:
+        schedule.waitFor(len(points)) #dwell on the last point too
+    return np.array(schedule.log)
+
+#intelligent advance: each step lasts until settling (a settlingDetector the readings go into) says the reading has
+#settled, between its minDwell and maxDwell. returns the step log (the scheduled time is when the step before it
+#was judged done), how many steps settled before maxDwell and how long the sweep took
+def stepSweepAdaptive(q, points, source, settling, progress=None, stopped=_never):
+    q.put(('write',(':system:azero once',)))
+    log = []
+    nSettled = 0
+    t0 = monotonic()
+    decided = 0.0
+    for i, point in enumerate(points):
+        if stopped():
+            break
+        settling.newStep() #before the step goes out so none of its readings get missed
+        q.put(('write',(':source:' + source + ' {0:.4f}'.format(point),)))
+        log.append((point, decided, monotonic() - t0))
+        dwell, settled = settling.wait()
+        decided = monotonic() - t0
+        nSettled = nSettled + settled
+        if progress is not None:
+            progress(float(i+1)/len(points)*100)
+    return np.array(log), nSettled, decided
+
+#seconds the 2400 takes per reading at nplc power line cycles, with average readings averaged into each (0 for none)
+def readingTime(nplc, average=0, lineFrequency=60.0):
+    return float(nplc)/lineFrequency*max(int(average), 1) + readingOverhead
+
+#how long each step of a hardware timed sweep really lasts: dt, unless samplesPerStep readings of tReading seconds
+#each don't fit in it (then the arm timer goes off before the last reading is done and the step stretches)
+def listStepTime(dt, samplesPerStep, tReading):
+    return samplesPerStep*max(float(dt)/samplesPerStep, tReading, armTimerMin)
+
+#hardware timed sweep: the points go up to the 2400 as source lists (at most listLimit points at a time, so long
+#sweeps are split into chunks) and the instrument's arm timer paces the readings, samplesPerStep per step, every
+#dt/samplesPerStep seconds however long each one takes (see listStepTime for when that's too short).
+#each list is run as a triggered burst into the buffer and read back as one binary block. the only timing slop left
+#is the short gap between chunks while the readings are fetched and the next list is sent. returns how many chunks
+#went out, each one comes back as one transaction
+def listSweep(q, credits, points, dt, source, samplesPerStep, options=None, listLimit=listLimit, progress=None, stopped=_never):
+    points = np.repeat(points, samplesPerStep)
+    chunks = [points[i:i+listLimit] for i in range(0, len(points), listLimit)]
+    depth = 2 #one chunk waiting behind the one running
+    options = dict(options or {}, credit=True)
+    q.put(('write',(':system:azero once',)))
+    q.put(('write',(':source:delay 0',)))
+    q.put(('write',(':trigger:count 1',)))
+    q.put(('write',(':arm:source timer',)))
+    q.put(('write',(':arm:timer {0:.6f}'.format(max(float(dt)/samplesPerStep, armTimerMin)),)))
+    q.put(('write',(':source:' + source + ':mode list',)))
+    q.put(('write',(':trace:feed sense',)))
+    inFlight = 0
+    for i, chunk in enumerate(chunks):
+        if inFlight >= depth: #wait for the worker to finish an earlier chunk before queuing another
+            credits.acquire()
+            inFlight = inFlight - 1
+            if progress is not None:
+                progress(float(i-depth+1)/len(chunks)*100)
+        if stopped(): #the chunks already queued finish, no more get sent
+            chunks = chunks[:i]
+            break
+        listString = ','.join(['{0:.4f}'.format(point) for point in chunk])
+        q.put(('write',(':source:list:' + source + ' ' + listString,)))
+        q.put(('write',(':trace:points {0:d};:arm:count {0:d}'.format(len(chunk)),)))
+        q.put(('query_raw',(burstQuery,),options))
+        inFlight = inFlight + 1
+    for i in range(inFlight):
+        credits.acquire()
+    #leave the instrument the way I,V vs t mode expects it
+    q.put(('write',(':source:' + source + ':mode fixed',)))
+    q.put(('write',(':arm:source immediate',)))
+    q.put(('write',(':arm:count 1',)))
+    q.put(('write',(':trace:feed:control never',)))
+    return len(chunks)
+
+#keep depth reading requests (a buffered burst each if burstReadings > 0) in flight at the worker until finished()
+#says the sweep's done, returns how many went out. the worker hands back one of the credits for each request it
+#finishes, the ones still in flight at the end are waited for so their credits don't leak into the next sweep
+def requestReadings(q, credits, burstReadings, finished, depth, options=None):
+    options = dict(options or {}, credit=True)
+    def request():
+        if burstReadings > 0: #the instrument fills its buffer with a triggered burst of readings, then we fetch them all in one binary block
+            q.put(('query_raw',(burstQuery,),options))
+        else:
+            q.put(('read',(),options))
+    for n in range(depth):
+        request()
+    nRequests = depth
+    while not finished():
+        if credits.acquire(True, 0.05): #the timeout is just so we notice finished
+            request()
+            nRequests = nRequests + 1
+    for n in range(depth):
+        credits.acquire(True, 10)
+    return nRequests
+
+#take a sweep's readings off the done queue (or out of ring, where the worker already decoded them, counting from
+#ringStart transactions) and hand each block of them to save, until target() transactions have come in. target()
+#is np.inf until the requests have stopped, after that a stall of stallTimeout seconds (failed requests don't come
+#back) ends it too. returns how many transactions came in and how many done queue items weren't readings
+def collectReadings(doneQueue, save, target, ring=None, ringStart=0, stallTimeout=None):
+    collected = 0
+    notData = 0
+    lastData = monotonic()
+    while True:
+        if ring is not None:
+            blocks = ring.blocksWritten() #everything up to this block is in the ring now
+            for view in ring.consume(timeout=0.1):
+                save(view)
+            ring.release()
+            arrived = blocks - ringStart - collected
+            collected = blocks - ringStart
+        else:
+            #take everything that's waiting in the done queue and decode it all in one go
+            try:
+                items = drainQueue(doneQueue, timeout=0.1) #time out now and then to notice target changing
+            except Empty:
+                items = []
+            data, rejected = decodeBlocks(items)
+            save(data)
+            arrived = len(items)
+            collected = collected + arrived
+            notData = notData + rejected
+        if arrived > 0:
+            lastData = monotonic()
+        if collected >= target():
+            break
+        if stallTimeout is not None and target() < np.inf and monotonic() - lastData > stallTimeout:
+            break
+    return collected, notData
+
+#I vs V: the 2400 runs the sweep it's set up for by itself, returns the readings as rows of voltage, current, time, status
+def readIVSweep(k, timeout=None):
+    return np.array(k.request('read_values').result(timeout)).reshape((-1, 4))
+
+#the settlingDetector for an intelligent advance sweep, the readings already requested when a step goes out get skipped
+def sweepSettling(source, minDwell, maxDwell, depth, burstReadings):
+    settling = settlingDetector(1 if source == 'voltage' else 0, minDwell, maxDwell)
+    settling.skipReadings = depth*max(burstReadings, 1)
+    return settling
+
+#save what goes next to a sweep's data (stem is the writer's): the step log, the per step transient summary and the
+#figures of merit of curve (voltages, currents), or of the settled value of each step when there's a transient
+#summary. returns the figures of merit, empty when there's nothing to work them out from
+def saveSweepExtras(stem, stepLog, transients, curve, area):
+    if stepLog is not None and len(stepLog) > 0:
+        np.savetxt(stem+'_steps.csv', stepLog, delimiter=",", header=stepHeader)
+    if transients is not None:
+        transients.save(stem+'_transients.csv', 'Current [A]' if transients.sensedColumn == 1 else 'Voltage [V]')
+        curve = transients.curve()
+    if curve is None:
+        return OrderedDict()
+    try:
+        area = float(area)
+    except ValueError:
+        area = np.nan
+    fom = figuresOfMerit(curve[0], curve[1], area)
+    saveFiguresOfMerit(stem+'_fom.json', fom)
+    return fom
+
+class acquisition:
+    pipelineDepth = pipelineDepth
+    burstPipelineDepth = burstPipelineDepth
+    listLimit = listLimit
+    stallTimeout = 10 #seconds without a reading before we give up on ones that aren't coming
+    timeout = 60 #seconds to wait for an I vs V sweep's data
+    writeBufferRows = 1<<20 #readings that can wait in memory for the disk (see dataWriters.bufferedWriter)
+    writePolicy = 'block' #'block', 'drop' or 'spill' when more are waiting than that
+    lineFrequency = 60.0 #Hz, setup asks the instrument
+
+    def __init__(self, k, log=None):
+        self.k = k #queue mode gpib
+        self.log = log if log is not None else lambda message: None
+        self.stopNow = threading.Event()
+        self.ring = k.ring if k.useRing else None
+        self.options = {'dest': 'ring'} if k.useRing else {} #worker options for the reading requests
+        self.ringBlocks = 0 #transactions taken out of the ring so far
+
+    #finish the sweep that's running early, no more sweeps after it
+    def stop(self):
+        self.stopNow.set()
+
+    def setup(self, recipe):
+        source = recipe['source']
+        sense = 'current' if source == 'voltage' else 'voltage'
+        maxAbs = max(abs(recipe['start']), abs(recipe['end']))
+        cmds = ['*rst'] + instrumentDefaults
+        cmds = cmds + [':route:terminals ' + ('rear' if recipe['rearTerminals'] else 'front'),
+                       ':system:rsense ' + ('ON' if recipe['fourWire'] else 'OFF'),
+                       ':system:azero ' + ('on' if recipe['autoZero'] else 'off')]
+        if recipe['average'] > 0:
+            cmds = cmds + [':sense:average on', ':sense:average:count {0:d}'.format(int(recipe['average']))]
+        else:
+            cmds = cmds + [':sense:average off']
+        cmds = cmds + [':source:function ' + source,
+                       ':sense:function "{0:s}:dc", "{1:s}:dc"'.format(sense, source),
+                       ':source:' + source + ':mode fixed',
+                       ':sense:' + sense + ':nplcycles {0:g}'.format(recipe['nplc']),
+                       ':sense:' + sense + ':protection {0:.3f}'.format(recipe['compliance']),
+                       ':sense:' + sense + ':range {0:.3f}'.format(recipe['compliance']),
+                       ':source:' + source + ':range {0:.3f}'.format(maxAbs),
+                       ':source:' + source + ' {0:.4f}'.format(recipe['start'])]
+        if recipe['mode'] == 'iv': #what handleModeCombo and updateDeltaText send for I vs V mode
+            nPoints = int(recipe['points'])
+            cmds = cmds + [':source:delay {0:0.3f}'.format(recipe['dt']), ':source:' + source + ':mode sweep',
+                           ':trigger:count {0:d}'.format(nPoints), ':source:sweep:points {0:d}'.format(nPoints),
+                           ':source:' + source + ':start {0:.4f}'.format(recipe['start']),
+                           ':source:' + source + ':stop {0:.4f}'.format(recipe['end'])]
+        else:
+            cmds = cmds + [':source:delay 0', ':trigger:count 1']
+            if recipe['burstReadings'] > 0 and not recipe['samplesPerStep']: #what initiateNewSweep adds for burst mode
+                cmds = cmds + burstCommands(int(recipe['burstReadings']))
+        for cmd in cmds:
+            self.k.write(cmd)
+        self.lineFrequency = float(self.k.ask(':system:lfrequency?', 10))
+
+    #I,V vs t: step the source in one thread, request readings in another (unless the 2400 paces it from its
+    #source list) and save the readings here as they come in, like the gui's threads do
+    def _runIVt(self, recipe, writer, stats):
+        points = np.linspace(recipe['start'], recipe['end'], int(recipe['points']))
+        source = recipe['source']
+        burstReadings = int(recipe['burstReadings'])
+        samplesPerStep = int(recipe['samplesPerStep'])
+        depth = self.burstPipelineDepth if burstReadings > 0 else self.pipelineDepth
+        self.transients = transientStats(points, 1 if source == 'voltage' else 0)
+        self.settling = None
+        if recipe['autoAdvance'] and samplesPerStep == 0:
+            self.settling = sweepSettling(source, recipe['minDwell'], recipe['dt'], depth, burstReadings)
+        if samplesPerStep > 0:
+            stepTime = listStepTime(recipe['dt'], samplesPerStep, readingTime(recipe['nplc'], recipe['average'], self.lineFrequency))
+            if stepTime > recipe['dt']:
+                self.log('{0:d} readings per step take longer than dt, each step will last {1:.4f} s'.format(samplesPerStep, stepTime))
+        done = threading.Event()
+        target = [np.inf] #transactions to collect, known once the requests have stopped
+
+        def step():
+            try:
+                if samplesPerStep > 0:
+                    target[0] = listSweep(self.k.task_queue, self.k.credits, points, recipe['dt'], source, samplesPerStep,
+                                          self.options, self.listLimit, stopped=self.stopNow.is_set)
+                elif self.settling is not None:
+                    self.stepLog, nSettled, took = stepSweepAdaptive(self.k.task_queue, points, source, self.settling,
+                                                                     stopped=self.stopNow.is_set)
+                    self.log('Intelligent advance: {0:d} of {1:d} points settled before the max dwell, sweep took {2:.2f} s'.format(nSettled, len(points), took))
+                else:
+                    self.stepLog = stepSweep(self.k.task_queue, points, recipe['dt'], source, stopped=self.stopNow.is_set)
+            finally:
+                done.set()
+        def measure():
+            target[0] = requestReadings(self.k.task_queue, self.k.credits, burstReadings, done.is_set, depth, self.options)
+        threads = [threading.Thread(target=step)]
+        if samplesPerStep == 0:
+            threads.insert(0, threading.Thread(target=measure))
+        for thread in threads:
+            thread.start()
+
+        def save(data):
+            writer.append(data)
+            stats.update(data)
+            self.transients.update(data)
+            if self.settling is not None:
+                self.settling.update(data)
+        collected, notData = collectReadings(self.k.done_queue, save, lambda: target[0], self.ring, self.ringBlocks,
+                                             self.stallTimeout)
+        self.ringBlocks = self.ringBlocks + collected
+        if collected < target[0]:
+            self.log('Gave up waiting for {0:d} readings'.format(target[0] - collected))
+        for thread in threads:
+            thread.join()
+        if notData > 0:
+            self.log("Skipped {0:d} items from the instrument that weren't binary readings".format(notData))
+
+    def _runIV(self, recipe, writer, stats):
+        self.k.write(':system:azero once')
+        data = readIVSweep(self.k, self.timeout)
+        writer.append(data)
+        stats.update(data)
+        self.curve = (data[:,0], data[:,1])
+
+    #one sweep (the instrument must be set up for it), saved through writer as it comes in, returns its sweepStats
+    #(its figures of merit end up in self.fom and <file>_fom.json)
+    def runSweep(self, recipe, writer):
+        stats = sweepStats()
+        self.stepLog = None
+        self.transients = None
+        self.curve = None
+        self.k.write(':output on')
+        try:
+            if recipe['mode'] == 'iv':
+                self._runIV(recipe, writer, stats)
+            else:
+                self._runIVt(recipe, writer, stats)
+        finally:
+            writer.close()
+        self.k.write(':source:' + recipe['source'] + ' {0:.4f}'.format(recipe['start'])) #back to the start for next time
+        self.fom = saveSweepExtras(writer.stem, self.stepLog, self.transients, self.curve, recipe['area'])
+        return stats
+
+    #all the sweeps the recipe asks for, returns a list of (file, parameters) for them
+    def runRecipe(self, recipe):
+        self.stopNow.clear()
+        saveTime = recipe['mode'] != 'iv'
+        savePath = os.path.join(recipe['outputDir'], recipe['name'])
+        session = sessionWriter(savePath) if recipe['session'] else None
+        results = []
+        try:
+            for n in range(int(recipe['sweeps'])):
+                if n > 0 and recipe['recovery'] > 0:
+                    self.stopNow.wait(recipe['recovery'])
+                if self.stopNow.is_set():
+                    break
+                sweepUp = recipe['end'] >= recipe['start']
+                if session is not None:
+                    settings = dict((key, value) for key, value in recipe.items() if key not in ('outputDir', 'name'))
+                    writer = session.newSweep(sweepFields(recipe['area'], saveTime, sweepUp), settings)
+                else:
+                    writer = openSweepFile(savePath, recipe['format'], recipe['area'], saveTime, sweepUp)
+                writer = bufferedWriter(writer, self.writeBufferRows, self.writePolicy)
+                stats = self.runSweep(recipe, writer)
+                parameters = stats.parameters()
+                parameters.update(self.fom)
+                bufferStats = writer.stats()
+                if bufferStats['delayedBlocks'] or bufferStats['droppedBlocks'] or bufferStats['spilledRows']:
+                    self.log('Disk fell behind: {0:s}'.format(str(dict(bufferStats))))
+                results.append((writer.path, parameters))
+                self.log('Sweep {0:d} of {1:d} saved to {2:s}: {3:s}'.format(n+1, int(recipe['sweeps']), writer.path, str(parameters)))
+        finally:
+            self.k.write(':output off')
+            if session is not None:
+                session.close()
+        return results
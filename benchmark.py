@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+headless acquisition throughput benchmark for the I,V vs t pipeline
+
+this drives the same sweepThread, measureThread, readRealTimeDataThread and postProcessThread that the gui uses
+(loaded from i-v-vs-time-taker.py) against an instrument (by default the simulated keithley from simKeithley.py)
+for a few different sweep lengths and reports:
+sustained samples/s, inter-sample interval percentiles and jitter (from the instrument's time stamps),
+how late each software paced source step went out compared to its schedule,
+task and done queue depths sampled during the sweep and the end-to-end save latency (sweep complete -> file saved)
+
+the results are printed as json (and optionally written to a file) so the sample rate can be tracked across releases:
+python benchmark.py --points 10,100,500 --dt 0.02 --json bench.json
+add --burst 100 to measure the buffered burst acquisition mode instead of one bus transaction per reading
+and --ring to move the readings through the shared memory ring buffer instead of the done queue
+--hardware 10 runs hardware timed (source list) sweeps with 10 readings per step instead of software paced ones
+"""
+from multiprocessing import freeze_support
+freeze_support()
+import os, sys, inspect
+import imp
+import json
+import time
+import shutil
+import tempfile
+import argparse
+
+import numpy as np
+from PyQt4.QtCore import QCoreApplication, QObject, QTimer, Qt
+
+from gpib import gpib
+from dataWriters import openSweepFile, bufferedWriter
+from acquisition import instrumentDefaults, burstCommands
+
+thisDir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+ivvt = imp.load_source('ivvt', os.path.join(thisDir, 'i-v-vs-time-taker.py'))
+
+#summarize an array of values, returns None for each entry if there's nothing to summarize
+def stats(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {'mean': None, 'max': None}
+    return {'mean': float(np.mean(values)), 'max': float(np.max(values))}
+
+#what a qsize call gives, or None if the platform doesn't implement it (macOS)
+def queueDepth(q):
+    try:
+        return q.qsize()
+    except NotImplementedError:
+        return None
+
+class benchmarkRunner(QObject):
+    def __init__(self, k, sweepLengths, dt, outDir, burstReadings=0, samplesPerStep=0, fileFormat='csv', parent=None):
+        QObject.__init__(self, parent)
+        self.k = k
+        self.sweepLengths = list(sweepLengths)
+        self.dt = dt
+        self.outDir = outDir
+        self.burstReadings = burstReadings
+        self.hardwareTimed = samplesPerStep > 0
+        self.fileFormat = fileFormat
+        self.results = []
+
+        #the same threads and connections MainWindow.initialSetup makes
+        self.postProcessThread = ivvt.postProcessThread()
+        self.postProcessThread.debug = False
+        self.measureThread = ivvt.measureThread(self.k.task_queue, self.k.credits)
+        self.sweepThread = ivvt.sweepThread(self.k.task_queue, self.k.credits)
+        if self.k.useRing:
+            self.measureThread.options = {'dest': 'ring'}
+            self.sweepThread.options = {'dest': 'ring'}
+            self.readRealTimeDataThread = ivvt.readRealTimeDataThread(self.k.done_queue, self.k.ring)
+        else:
+            self.readRealTimeDataThread = ivvt.readRealTimeDataThread(self.k.done_queue)
+        self.measureThread.burstReadings = burstReadings
+        self.sweepThread.hardwareTimed = self.hardwareTimed
+        if self.hardwareTimed:
+            self.sweepThread.samplesPerStep = samplesPerStep
+
+        #these only take time stamps so they run directly in the emitting thread
+        self.sweepThread.sweepComplete.connect(self.markSweepComplete, Qt.DirectConnection)
+        self.sweepThread.stepLog.connect(self.catchStepLog, Qt.DirectConnection)
+        self.postProcessThread.postProcessingComplete.connect(self.markSaved, Qt.DirectConnection)
+
+        self.measureThread.measureDone.connect(self.readRealTimeDataThread.updatePoints)
+        self.sweepThread.listDone.connect(self.readRealTimeDataThread.updatePoints)
+        self.readRealTimeDataThread.postStream.connect(self.postProcessThread.acceptStream)
+        self.postProcessThread.readyToProcess.connect(self.saveOutputFile)
+        self.sweepThread.stepLog.connect(self.postProcessThread.acceptStepLog)
+        self.sweepThread.sweepComplete.connect(self.measureThread.timeToDie)
+        self.postProcessThread.postProcessingComplete.connect(self.runDone)
+
+        #sample the queue depths while the sweep runs
+        self.depthTimer = QTimer()
+        self.depthTimer.setInterval(10)
+        self.depthTimer.timeout.connect(self.sampleDepths)
+
+    def markSweepComplete(self):
+        self.sweepCompleteTime = time.time()
+
+    def markSaved(self):
+        self.savedTime = time.time()
+
+    def catchStepLog(self, log):
+        self.lateness = (log[:,2] - log[:,1])*1000
+
+    def sampleDepths(self):
+        taskDepth = queueDepth(self.k.task_queue)
+        doneDepth = queueDepth(self.k.done_queue)
+        if taskDepth is not None:
+            self.taskDepths.append(taskDepth)
+        if doneDepth is not None:
+            self.doneDepths.append(doneDepth)
+
+    #what MainWindow.saveOutputFile does
+    def saveOutputFile(self):
+        self.postProcessThread.saveTime = True
+        self.postProcessThread.area = '1'
+        self.postProcessThread.savePath = self.savePath
+        self.postProcessThread.sweepUp = True
+        self.postProcessThread.start()
+
+    def start(self):
+        self.nextRun()
+
+    def nextRun(self):
+        if not self.sweepLengths:
+            QCoreApplication.instance().quit()
+            return
+        self.nPoints = self.sweepLengths.pop(0)
+        self.taskDepths = []
+        self.doneDepths = []
+        self.lateness = np.array([])
+        self.sweepThread.updateVariables(self.dt, np.linspace(0, 0.8, self.nPoints), 'voltage')
+        self.savePath = os.path.join(self.outDir, 'bench{0:d}'.format(self.nPoints))
+        self.readRealTimeDataThread.writer = bufferedWriter(openSweepFile(self.savePath, self.fileFormat, '1', True, True)) #like MainWindow.initiateNewSweep
+        self.depthTimer.start()
+        self.startTime = time.time()
+        self.readRealTimeDataThread.start()
+        if not self.hardwareTimed:
+            self.measureThread.start()
+        self.sweepThread.start()
+
+    def runDone(self):
+        self.depthTimer.stop()
+        self.readRealTimeDataThread.wait()
+        wallTime = self.savedTime - self.startTime
+        savedFile = self.postProcessThread.savedFile
+        loadStart = time.time() #read back once we're done timing
+        if self.fileFormat == 'npy':
+            t = np.load(savedFile, mmap_mode='r')[:,2]
+        else:
+            t = np.loadtxt(savedFile, delimiter=',', ndmin=2)[:,2]
+        loadTime = time.time() - loadStart
+        t = t - t[0]
+        intervals = np.diff(t)*1000
+        self.results.append({
+            'sweepPoints': self.nPoints,
+            'nSamples': len(t),
+            'acquisitionTime[s]': float(t[-1]),
+            'wallTime[s]': wallTime,
+            'samplesPerSecond': (len(t) - 1)/float(t[-1]),
+            'intervalPercentiles[ms]': dict(('p{0:d}'.format(p), float(np.percentile(intervals, p))) for p in (50, 90, 99, 100)),
+            'jitter[ms]': float(np.std(intervals)),
+            'stepLateness[ms]': stats(self.lateness),
+            'taskQueueDepth': stats(self.taskDepths),
+            'doneQueueDepth': stats(self.doneDepths),
+            'saveLatency[ms]': (self.savedTime - self.sweepCompleteTime)*1000,
+            'fileSize[bytes]': os.path.getsize(savedFile),
+            'loadTime[ms]': loadTime*1000})
+        self.nextRun()
+
+#put the instrument into the state MainWindow.initialSetup and handleModeCombo leave it in for I,V vs t mode
+def setupInstrument(k, burstReadings=0):
+    for cmd in ['*rst'] + instrumentDefaults + [':system:azero off', ':sense:average off', ':source:function voltage',
+                ':sense:function "current:dc", "voltage:dc"', ':sense:current:protection 0.1', ':sense:current:range 0.1',
+                ':sense:current:nplcycles 0.01', ':source:delay 0', ':source:voltage:mode fixed', ':trigger:count 1',
+                ':source:voltage 0', ':output on']:
+        k.write(cmd)
+    if burstReadings > 0: #what MainWindow.initiateNewSweep adds for burst mode
+        for cmd in burstCommands(burstReadings):
+            k.write(cmd)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the I,V vs t acquisition pipeline.')
+    parser.add_argument('--address', default='SIM::2400', help='instrument location string (default: a simulated 2400)')
+    parser.add_argument('--points', default='10,100,500', help='comma separated list of sweep lengths to run')
+    parser.add_argument('--dt', type=float, default=0.02, help='step delay in seconds')
+    parser.add_argument('--burst', type=int, default=0, help='readings per buffered burst (default: 0, one reading per bus transaction)')
+    parser.add_argument('--hardware', type=int, default=0, help='readings per step for hardware timed sweeps (default: 0, software paced)')
+    parser.add_argument('--ring', action='store_true', help='send readings through shared memory instead of the done queue')
+    parser.add_argument('--format', default='csv', choices=['csv', 'npy'], help='output file format (default: csv)')
+    parser.add_argument('--json', default=None, help='also write the results to this file')
+    args = parser.parse_args()
+
+    app = QCoreApplication(sys.argv)
+    k = gpib(args.address, useQueues=True, timeout=None, useRing=args.ring)
+    setupInstrument(k, args.burst)
+    outDir = tempfile.mkdtemp()
+    runner = benchmarkRunner(k, [int(n) for n in args.points.split(',')], args.dt, outDir, args.burst, args.hardware, args.format)
+    QTimer.singleShot(0, runner.start)
+    app.exec_()
+
+    k.write(':output off')
+    backpressure = {'doneQueueStalls': k.doneQueueStalls()}
+    if k.useRing:
+        backpressure['ringStalls'] = int(k.ring.stalls.value)
+        backpressure['ringDropped'] = int(k.ring.dropped.value)
+    k.__del__()
+    shutil.rmtree(outDir)
+
+    report = {'address': args.address, 'dt[s]': args.dt, 'burstReadings': args.burst, 'ring': args.ring, 'samplesPerStep': args.hardware, 'format': args.format, 'time': time.time(), 'backpressure': backpressure, 'runs': runner.results}
+    print(json.dumps(report, indent=4, sort_keys=True))
+    if args.json is not None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=4, sort_keys=True)
+
+if __name__ == "__main__":
+    main()
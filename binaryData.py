@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""
+helpers for turning the keithley's binary (:format:data sreal) transfers into numpy arrays in bulk
+
+every item the instrument sends is a '#0' header followed by big endian IEEE-754 single precision values,
+nElements of them per reading (one reading for a plain read, many for a burst fetched from the buffer)
+instead of unpacking these one at a time, drainQueue grabs everything that's waiting and decodeBlocks turns it
+into one array with a single np.frombuffer call
+"""
+import numpy as np
+
+try:
+    from queue import Empty
+except ImportError:
+    from Queue import Empty
+
+#wait for one item from the queue then also take everything else that's already waiting in it (up to maxItems)
+def drainQueue(q, maxItems=None, timeout=None):
+    items = [q.get(True, timeout)]
+    while maxItems is None or len(items) < maxItems:
+        try:
+            items.append(q.get_nowait())
+        except Empty:
+            break
+    return items
+
+#decode a list of raw binary items from the instrument into an (nReadings, nElements) float32 array
+#items that don't start with the '#0' header aren't readings (a stray query response maybe) and get skipped,
+#returns the array and the number of skipped items
+def decodeBlocks(items, nElements=4):
+    recordSize = nElements*4
+    payloads = []
+    rejected = 0
+    for item in items:
+        if item[:2] != b'#0':
+            rejected = rejected + 1
+            continue
+        nReadings = (len(item)-2)//recordSize #anything after the last full reading is the termination character
+        payloads.append(item[2:nReadings*recordSize+2])
+    data = np.frombuffer(b''.join(payloads), dtype='>f4').reshape((-1, nElements))
+    return data, rejected
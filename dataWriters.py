@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+"""
+here we have the code that puts sweep data on disk
+
+streamingCsvWriter writes the same csv files np.savetxt used to write in one go at the end of a sweep, but it
+writes them a block at a time as the data comes in. the file is built up under a .part name next to its final
+destination and renamed into place once the sweep is done, so a finished file is always complete and a crash mid
+sweep leaves everything collected up until then in the .part file:
+w = streamingCsvWriter('/data/cell1_1400000000.csv', sweepHeader('0.12', True, True))
+w.append(block) #as many times as needed, block is (n, 4)
+w.close()
+
+streamingNpyWriter does the same thing but writes a .npy file holding the float32 values exactly as the instrument
+sent them, that's several times smaller and faster to write than text and it can be memory mapped when read back:
+np.load('cell1_1400000000.npy', mmap_mode='r')
+the csv header fields go into a json file alongside it (cell1_1400000000.npy.json)
+
+openSweepFile picks the right one for the output format and works out the file name
+
+bufferedWriter puts a bounded queue and a thread of its own in front of any of these (or a session sweep), so a slow
+or stalled disk doesn't hold up whoever's appending. when more than maxRows rows are waiting the policy decides:
+'block' -- append waits for room, which backs the data path up to the gpib worker (nothing's lost, readings are late)
+'drop' -- the block is thrown away
+'spill' -- blocks go to a temporary file (in spillDir) until the writer has caught up, nothing's lost or late
+w = bufferedWriter(openSweepFile(...), maxRows=1<<20, policy='block')
+w.append(block) #copies block, so views into buffers that get reused are fine
+w.close() #waits for everything to be written
+w.stats() #what the policy had to do: delayed blocks and seconds waited, dropped and spilled rows, the most rows queued
+"""
+import os
+import time
+import json
+import struct
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict, deque
+from timing import monotonic
+
+#which columns get saved and what they're called
+def sweepColumns(saveTime):
+    if not saveTime:#only save iv data
+        return [0,1], ['Voltage [V]','Current [A]']
+    else:
+        return [0,1,2,3], ['Voltage [V]','Current [A]','Time[s]','Status']
+
+#the header every output file starts with, the Area/I&V vs t/sweepUp lines are what analysis scripts look for
+def sweepHeader(area, saveTime, sweepUp):
+    hdr = 'Area = {0:s} [cm^2]\n'.format(area)
+    hdr = hdr + 'I&V vs t = {0:b}\n'.format(saveTime)
+    hdr = hdr + 'sweepUp = {0:b}\n'.format(sweepUp)
+    return hdr + ','.join(sweepColumns(saveTime)[1])
+
+#the same header information for the json sidecar of binary files
+def sweepFields(area, saveTime, sweepUp):
+    fields = OrderedDict()
+    fields['Area [cm^2]'] = area
+    fields['I&V vs t'] = bool(saveTime)
+    fields['sweepUp'] = bool(sweepUp)
+    fields['columns'] = sweepColumns(saveTime)[1]
+    return fields
+
+#open a new output file for a sweep, named <savePath>_<unix time>.<fileFormat> (fileFormat is 'csv' or 'npy')
+#if there's already a file for this second (sweeps can be that short) the next free second gets used instead
+def openSweepFile(savePath, fileFormat, area, saveTime, sweepUp):
+    columns = sweepColumns(saveTime)[0]
+    stamp = int(time.time())
+    path = savePath+'_'+str(stamp)+'.'+fileFormat
+    while os.path.exists(path) or os.path.exists(path + '.part'):
+        stamp = stamp + 1
+        path = savePath+'_'+str(stamp)+'.'+fileFormat
+    if fileFormat == 'npy':
+        return streamingNpyWriter(path, sweepFields(area, saveTime, sweepUp), columns)
+    else:
+        return streamingCsvWriter(path, sweepHeader(area, saveTime, sweepUp), columns)
+
+#sweep parameters as plain floats for json, which has no nan or inf, so those become null
+def jsonParameters(parameters):
+    return dict((key, float(value) if np.isfinite(value) else None) for key, value in parameters.items())
+
+#write a small json file atomically
+def writeJson(path, fields):
+    with open(path + '.part', 'w') as f:
+        json.dump(fields, f, indent=4)
+    if os.path.exists(path):
+        os.remove(path)
+    os.rename(path + '.part', path)
+
+class streamingCsvWriter:
+    def __init__(self, path, header, columns=None):
+        self.path = path
+        self.partPath = path + '.part'
+        self.stem = os.path.splitext(path)[0] #for files that go with this one
+        self.columns = columns #which columns of the appended blocks to save, None for all of them
+        self.rows = 0
+        self.f = open(self.partPath, 'w')
+        for line in header.split('\n'): #same comment style np.savetxt uses for headers
+            self.f.write('# ' + line + '\n')
+        self.f.flush()
+
+    def append(self, block):
+        if len(block) == 0:
+            return
+        if self.columns is not None:
+            block = block[:,self.columns]
+        np.savetxt(self.f, block, delimiter=",")
+        self.f.flush() #get it out of our process so it survives us crashing
+        self.rows = self.rows + len(block)
+
+    #make sure everything is on disk, then move the file to its final name
+    def close(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        if os.path.exists(self.path): #rename won't replace on windows
+            os.remove(self.path)
+        os.rename(self.partPath, self.path)
+
+class streamingNpyWriter:
+    headerLength = 128 #fixed so the header can be rewritten in place as the row count grows
+
+    def __init__(self, path, fields, columns=None, nColumns=4):
+        self.path = path
+        self.partPath = path + '.part'
+        self.stem = os.path.splitext(path)[0] #for files that go with this one
+        self.fields = fields #goes in the json sidecar
+        self.columns = columns #which columns of the appended blocks to save, None for all of them
+        self.nColumns = len(columns) if columns is not None else nColumns
+        self.rows = 0
+        self.f = open(self.partPath, 'wb')
+        self.f.write(self._header())
+        self.f.flush()
+
+    #.npy format version 1.0 header for float32 data with the rows we have so far
+    def _header(self):
+        d = "{{'descr': '<f4', 'fortran_order': False, 'shape': ({0:d}, {1:d}), }}".format(self.rows, self.nColumns)
+        d = d.ljust(self.headerLength - 10 - 1) + '\n'
+        return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(d)) + d.encode('latin1')
+
+    def append(self, block):
+        if len(block) == 0:
+            return
+        if self.columns is not None:
+            block = block[:,self.columns]
+        self.f.write(np.ascontiguousarray(block, dtype='<f4').tobytes())
+        self.rows = self.rows + len(block)
+        #keep the header's row count current so even the .part file is a valid .npy
+        self.f.seek(0)
+        self.f.write(self._header())
+        self.f.seek(0, 2)
+        self.f.flush()
+
+    def close(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.f.close()
+        if os.path.exists(self.path): #rename won't replace on windows
+            os.remove(self.path)
+        os.rename(self.partPath, self.path)
+        fields = OrderedDict(self.fields)
+        fields['nSamples'] = self.rows
+        writeJson(self.path + '.json', fields)
+
+class bufferedWriter:
+    policies = ['block', 'drop', 'spill']
+    spillChunk = 65536 #rows read back from the spill file at a time
+
+    def __init__(self, writer, maxRows=1<<20, policy='block', spillDir=None):
+        if policy not in self.policies:
+            raise ValueError('Unknown buffer policy: {0:s}'.format(policy))
+        self.writer = writer
+        self.maxRows = maxRows
+        self.policy = policy
+        self.spillDir = spillDir #None for the system's temporary folder
+        self.cv = threading.Condition()
+        self.blocks = deque()
+        self.queuedRows = 0
+        self.spill = None #temporary file for the spill policy
+        self.spillRows = 0 #rows in the spill file that haven't been written yet
+        self.spillRead = 0 #byte offsets into it
+        self.spillWrite = 0
+        self.closing = False
+        self.error = None #what the writer thread ran into, raised from the next append or close
+        self.delayedBlocks = 0
+        self.delayTime = 0.0
+        self.droppedBlocks = 0
+        self.droppedRows = 0
+        self.spilledRows = 0
+        self.peakRows = 0
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    #path, stem, rows... come from the writer underneath
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def append(self, block):
+        if len(block) == 0:
+            return
+        block = np.array(block)
+        with self.cv:
+            if self.error is not None:
+                raise self.error
+            full = self.queuedRows + len(block) > self.maxRows
+            if self.spillRows > 0 or (full and self.policy == 'spill'): #once spilling, keep at it so the order stays right
+                self._spill(block)
+                return
+            if full and self.policy == 'drop':
+                self.droppedBlocks = self.droppedBlocks + 1
+                self.droppedRows = self.droppedRows + len(block)
+                return
+            if full:
+                self.delayedBlocks = self.delayedBlocks + 1
+                start = monotonic()
+                while self.queuedRows > 0 and self.queuedRows + len(block) > self.maxRows and self.error is None:
+                    self.cv.wait(0.1)
+                self.delayTime = self.delayTime + monotonic() - start
+            self.blocks.append(block)
+            self.queuedRows = self.queuedRows + len(block)
+            self.peakRows = max(self.peakRows, self.queuedRows)
+            self.cv.notify_all()
+
+    def _spill(self, block):
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(dir=self.spillDir)
+            self.spillColumns = block.shape[1]
+            self.spillDtype = block.dtype
+        self.spill.seek(self.spillWrite)
+        self.spill.write(block.astype(self.spillDtype).tobytes())
+        self.spillWrite = self.spill.tell()
+        self.spillRows = self.spillRows + len(block)
+        self.spilledRows = self.spilledRows + len(block)
+        self.cv.notify_all()
+
+    def _unspill(self):
+        nRows = min(self.spillRows, self.spillChunk)
+        self.spill.seek(self.spillRead)
+        nBytes = nRows*self.spillColumns*self.spillDtype.itemsize
+        block = np.frombuffer(self.spill.read(nBytes), dtype=self.spillDtype).reshape((-1, self.spillColumns))
+        self.spillRead = self.spill.tell()
+        self.spillRows = self.spillRows - nRows
+        if self.spillRows == 0: #drained, so start over at the top instead of letting the file grow for the whole run
+            self.spill.truncate(0)
+            self.spillRead = 0
+            self.spillWrite = 0
+        return block
+
+    def _run(self):
+        while True:
+            with self.cv:
+                while not self.blocks and self.spillRows == 0 and not self.closing:
+                    self.cv.wait()
+                if self.blocks: #these came before anything in the spill file
+                    block, queued = self.blocks[0], True
+                elif self.spillRows > 0:
+                    block, queued = self._unspill(), False
+                else:
+                    return
+            try:
+                self.writer.append(block)
+            except Exception as e:
+                with self.cv:
+                    self.error = e
+                    self.cv.notify_all()
+                return
+            if queued:
+                with self.cv:
+                    self.blocks.popleft()
+                    self.queuedRows = self.queuedRows - len(block)
+                    self.cv.notify_all()
+
+    #write out everything that's waiting, then close the writer underneath
+    def close(self):
+        with self.cv:
+            self.closing = True
+            self.cv.notify_all()
+        self.thread.join()
+        if self.spill is not None:
+            self.spill.close()
+        if self.error is not None:
+            raise self.error
+        self.writer.close()
+
+    def stats(self):
+        return OrderedDict([('delayedBlocks', self.delayedBlocks), ('delayTime[s]', self.delayTime),
+                            ('droppedBlocks', self.droppedBlocks), ('droppedRows', self.droppedRows),
+                            ('spilledRows', self.spilledRows), ('peakQueuedRows', self.peakRows)])
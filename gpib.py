@@ -19,6 +19,32 @@ from pygrey.gpib import gpib
 k.task_queue.put(('ask',('*idn?',)))
 print k.done_queue.get()
 k.task_queue.put('STOP') <-- this cleans things up properly
+a task can carry a third element, a dict of options for the worker:
+{'dest': 'ring'} -- the (binary) result is decoded and written into the shared memory ring buffer k.ring instead of
+                    done_queue, this needs useRing=True at init. use it for high rate readings:
+k.task_queue.put(('read_raw',(),{'dest': 'ring'}))
+{'credit': True} -- the worker releases the k.credits semaphore once it's done with the task (even if it failed),
+                    so a client can keep a fixed number of requests in flight without polling the queue size
+{'id': n} -- the result goes to k.reply_queue tagged with n instead of into done_queue, whatever it is (None
+             included) and any exception raised comes back in its place. you don't use this one directly, use
+             request() which hands back a gpibFuture for the result, so any number of threads can have requests in
+             flight without one taking another's answer off done_queue:
+f = k.request('ask',':system:mep:state?')
+print f.result(timeout=10) #raises gpibError if the call failed or timed out
+print k.ask('*idn?',timeout=10) #same thing in one go, works in non-queue mode too
+besides the visa object's functions there's the 'query_raw' task, it writes a query and reads the (binary) answer
+back in one go so no other client's write can get in between the two:
+k.task_queue.put(('query_raw',(':trace:data?',),{'dest': 'ring'}))
+plain writes (no options) that are queued back to back get sent as one ';' joined message, with any that get
+overwritten before anything could notice dropped (see scpi.coalesce), set coalesceWrites = False to send each one
+on its own
+every write that goes through task_queue is noted in k.shadow (a scpi.shadowState), and k.write skips any write that
+wouldn't change a setting from what we last set it to (k.suppressedWrites counts those). *rst and 'clear' tasks
+forget everything, call k.shadow.invalidate() if the instrument could have been changed some other way (front panel)
+done_queue holds at most doneQueueSize results, past that the worker waits for the client to take some (and stops
+finishing tasks, so a client that keeps a fixed number of credits in flight stops asking for more) instead of filling
+memory. k.doneQueueStalls() counts the results that had to wait. the ring buffer does the same when it's full unless
+ringFullPolicy is 'drop' (see ringBuffer.py)
 in non-queue mode:
 the user will interact with the visa v object created during initialization
 example:
@@ -28,76 +54,283 @@ print k.v.ask(':read?')
 
 see the pyvisa documentation on how to interact with a visa object
 
+for benchmarking and testing without hardware, give a location string starting with SIM to get a simulated keithley 2400
+(see simKeithley.py), this works in both modes and doesn't need pyvisa:
+k = gpib('SIM::2400::latency=0.002',useQueues=True)
+
 @author: Grey Christoforo <first name [at] last name [dot] net>
 """
 from multiprocessing import freeze_support
 freeze_support()
 	
-import visa
-from multiprocessing import Process, Queue
+try:
+    import visa
+except ImportError:
+    visa = None #only the simulated instrument will work
+from simKeithley import simKeithley
+from ringBuffer import ringBuffer
+from binaryData import decodeBlocks, Empty
+try:
+    from queue import Full
+except ImportError:
+    from Queue import Full
+from scpi import coalesce, shadowState
+from multiprocessing import Process, Queue, Semaphore
+from multiprocessing.sharedctypes import RawValue
+import ctypes
+import threading
+import itertools
+import functools
+
+#the 'query_raw' task: write query then read back what the instrument says to it
+def queryRaw(v, query):
+    v.write(query)
+    return v.read_raw()
+
+#tasks the worker does itself in terms of the visa object's functions, name: function(visa object, *args)
+compoundTasks = {'query_raw': queryRaw}
+
+#what a request's future raises when the call failed in the worker or the result didn't come back in time
+class gpibError(Exception):
+    pass
+
+#task_queue as clients see it: a multiprocessing Queue that keeps the shadow state up to date with the writes put in it
+class shadowQueue:
+    def __init__(self, q, shadow):
+        self.q = q
+        self.shadow = shadow
+
+    def put(self, task, *args, **kwargs):
+        if task != 'STOP':
+            if task[0] in ('write', 'query_raw'):
+                self.shadow.record(task[1][0])
+            elif task[0] == 'clear':
+                self.shadow.invalidate()
+        self.q.put(task, *args, **kwargs)
+
+    def __getattr__(self, name): #everything else is the queue's
+        return getattr(self.q, name)
+
+#the result of a request(), filled in by the dispatcher thread when the worker is done with it
+class gpibFuture:
+    def __init__(self, requestId):
+        self.id = requestId
+        self._done = threading.Event()
+        self._ok = False
+        self._value = None
+
+    def _set(self, ok, value):
+        self._ok = ok
+        self._value = value
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    #wait up to timeout seconds (None for forever) for the call's return value
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise gpibError('Timed out waiting for request {0:d}'.format(self.id))
+        if not self._ok:
+            raise self._value
+        return self._value
 
 class gpib:
     delay = 0#command transmit delay
-    values_format = visa.single | visa.big_endian #this is now a keithley 2400 does binary transfers
+    values_format = visa.single | visa.big_endian if visa is not None else None #this is now a keithley 2400 does binary transfers
     chunk_size = 102400 #need a slightly bigger transfer buffer than default to be able to transfer a full sample buffer (2500 samples) from a keithley 2400 in one shot
-    def __init__(self,locationString=None,timeout=30,useQueues=False):
+    ringCapacity = 65536 #readings the shared memory ring buffer can hold
+    ringFullPolicy = 'block' #what the worker does when the ring buffer is full, 'block' or 'drop' (see ringBuffer.py)
+    doneQueueSize = 4096 #results done_queue can hold before the worker waits for the client to take some
+    coalesceWrites = True #in queue mode, join up writes that are waiting in the queue together
+    maxMessageLength = 256 #characters in a joined up write, well under what the 2400's input buffer holds
+    def __init__(self,locationString=None,timeout=30,useQueues=False,useRing=False):
         self.locationString = locationString
         self.timeout = timeout
         self.useQueues = useQueues
+        self.useRing = useRing
+        self.simulated = locationString is not None and locationString.upper().startswith('SIM')
+        self.suppressedWrites = 0
 
         if self.locationString is not None:
             if self.useQueues: #queue mode
                 #build the queues
-                self.task_queue = Queue()
-                self.done_queue = Queue()
+                tasks = Queue()
+                self.done_queue = Queue(self.doneQueueSize)
+                self.doneStalls = RawValue(ctypes.c_ulonglong, 0) #results the worker had to wait to put in done_queue
+                self.reply_queue = Queue() #(request id, ok, result) for request()
+                self.credits = Semaphore(0) #released by the worker after each task that asks for it
+                if self.useRing: #shared memory for the high rate data path
+                    self.ring = ringBuffer(4,self.ringCapacity,self.ringFullPolicy)
                 #kickoff the worker process
-                self.p = Process(target=self._worker, args=(self.task_queue, self.done_queue))
+                self.p = Process(target=self._worker, args=(tasks, self.done_queue, self.reply_queue))
                 self.p.start()
+                #set up after the worker starts so none of this has to be sent over to it
+                self.shadow = shadowState() #what we've set the instrument to
+                self.task_queue = shadowQueue(tasks, self.shadow)
+                self.requestIds = itertools.count()
+                self.pending = {} #request id: gpibFuture
+                self.pendingLock = threading.Lock()
+                self.dispatcher = threading.Thread(target=self._dispatch)
+                self.dispatcher.daemon = True
+                self.dispatcher.start()
             else:#non-queue mode
-                self.v = visa.instrument(self.locationString,timeout=self.timeout,chunk_size=self.chunk_size,delay=self.delay,values_format=self.values_format)
+                self.v = self._openInstrument()
+                self.shadow = shadowState() #what we've set the instrument to
 
     def __del__(self):
         if self.useQueues:
             if self.p.is_alive():
                 self.task_queue.put('STOP')
-            self.p.join()
+            while self.p.is_alive(): #the worker could be waiting for room in done_queue
+                try:
+                    while True:
+                        self.done_queue.get_nowait()
+                except Empty:
+                    pass
+                self.p.join(0.1)
+            if self.dispatcher.is_alive():
+                self.reply_queue.put(None) #stops the dispatcher
+                self.dispatcher.join()
             self.task_queue.close()
             self.done_queue.close()
+            self.reply_queue.close()
             self.task_queue.join_thread()
             self.done_queue.join_thread()
+            self.reply_queue.join_thread()
         else:
             if hasattr(self,'v'):
                 self.v.close()
 
-    def _worker(self, inputQ, outputQ):
+    #make the instrument object, either a real visa one or a simulated keithley
+    def _openInstrument(self):
+        if self.simulated:
+            return simKeithley(self.locationString,timeout=self.timeout,chunk_size=self.chunk_size,delay=self.delay,values_format=self.values_format)
+        else:
+            return visa.instrument(self.locationString,timeout=self.timeout,chunk_size=self.chunk_size,delay=self.delay,values_format=self.values_format)
+
+    def _worker(self, inputQ, outputQ, replyQ):
         #local, threadsafe instrument object created here
-        v = visa.instrument(self.locationString,timeout=self.timeout,chunk_size=self.chunk_size,delay=self.delay,values_format=self.values_format)
-        for func, args in iter(inputQ.get, 'STOP'):#queue processing going on here
+        v = self._openInstrument()
+        held = None #a task taken off the queue while looking for writes to join up, it's next
+        while True:#queue processing going on here
+            if held is not None:
+                task, held = held, None
+            else:
+                task = inputQ.get()
+            if task == 'STOP':
+                break
+            func, args = task[0], task[1]
+            options = task[2] if len(task) > 2 else {}
+            if func == 'write' and not options and self.coalesceWrites:
+                writes = [args[0]]
+                while True: #gather up the plain writes queued right behind this one
+                    try:
+                        held = inputQ.get_nowait()
+                    except Empty:
+                        held = None
+                        break
+                    if held != 'STOP' and held[0] == 'write' and (len(held) < 3 or not held[2]):
+                        writes.append(held[1][0])
+                        held = None
+                    else:
+                        break
+                messages = coalesce(writes, self.maxMessageLength)
+                for message in messages[:-1]:
+                    try:
+                        v.write(message)
+                    except:
+                        pass
+                args = (messages[-1],) if messages else ('',)
+            error = None
             try:
-                toCall = getattr(v,func)
+                toCall = functools.partial(compoundTasks[func], v) if func in compoundTasks else getattr(v,func)
                 ret = toCall(*args)#visa function call occurs here
-            except:
+            except Exception as e:
                 ret = None
-            if ret: #don't put None outputs into output queue
-                outputQ.put(ret)
+                error = gpibError('{0:s}{1:s} failed: {2:s}'.format(func, str(args), repr(e))) #visa's own exceptions might not pickle
+            if 'id' in options: #a request(), its future gets the result whatever it is
+                if error is None:
+                    replyQ.put((options['id'], True, ret))
+                else:
+                    replyQ.put((options['id'], False, error))
+            elif options.get('dest') == 'ring': #decode here and put the readings straight into shared memory
+                if ret:
+                    records, rejected = decodeBlocks([ret],self.ring.nColumns)
+                else:
+                    records = []
+                self.ring.write(records) #written even when empty so the reader can count transactions
+            elif ret: #don't put None outputs into output queue
+                try:
+                    outputQ.put(ret,False)
+                except Full: #the client's fallen behind, wait for it
+                    self.doneStalls.value = self.doneStalls.value + 1
+                    outputQ.put(ret)
+            if options.get('credit'):
+                self.credits.release()
         print "queue worker closed properly"
         v.close()
         inputQ.close()
         outputQ.close()
+        replyQ.close()
 
-    #make queue'd and non-queued writes look the same to the client
+    #hand the worker's replies to request() to the futures waiting for them
+    def _dispatch(self):
+        for requestId, ok, value in iter(self.reply_queue.get, None):
+            with self.pendingLock:
+                future = self.pending.pop(requestId, None)
+            if future is not None:
+                future._set(ok, value)
+
+    #call visa function func with args on the instrument, returns a gpibFuture for the result
+    #options are the same as for tasks (see above), 'credit' is the one that makes sense here
+    def request(self, func, *args, **options):
+        if not self.useQueues: #just do it now
+            future = gpibFuture(0)
+            try:
+                toCall = functools.partial(compoundTasks[func], self.v) if func in compoundTasks else getattr(self.v,func)
+                future._set(True, toCall(*args))
+            except Exception as e:
+                future._set(False, gpibError('{0:s}{1:s} failed: {2:s}'.format(func, str(args), repr(e))))
+            return future
+        with self.pendingLock:
+            requestId = next(self.requestIds)
+            future = gpibFuture(requestId)
+            self.pending[requestId] = future
+        options['id'] = requestId
+        self.task_queue.put((func, args, options))
+        return future
+
+    #send a query and wait for the answer
+    def ask(self, query, timeout=None):
+        return self.request('ask', query).result(timeout)
+
+    #make queue'd and non-queued writes look the same to the client, writes that wouldn't change anything are skipped
     def write(self,string):
+        if self.shadow.isCurrent(string):
+            self.suppressedWrites = self.suppressedWrites + 1
+            return
         if self.useQueues:
             self.task_queue.put(('write',(string,)))
         else:
+            self.shadow.record(string)
             self.v.write(string)
 
+    #results the worker had to wait to hand over because done_queue was full
+    def doneQueueStalls(self):
+        return int(self.doneStalls.value)
+
+    #true if writing string wouldn't change anything on the instrument
+    def isCurrent(self,string):
+        return self.shadow.isCurrent(string)
+
     #controls remote enable line
     def controlRen(self,mode):
         visa.Gpib()._vpp43.gpib_control_ren(mode)
 
     def clearInterface(self):
-        visa.Gpib().send_ifc()
+        if not self.simulated: #there's no bus to clear for a simulated instrument
+            visa.Gpib().send_ifc()
 
     def findInstruments(self):
         return visa.get_instruments_list()    
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+here we have the command line runner, it does sweeps without the gui (no PyQt needed, so it starts fast and can
+run from cron or over ssh)
+
+a sweep recipe (see acquisition.py for the keys) comes from a json file, the command line or both (the command
+line wins), the data gets saved the same way the gui saves it and a summary of every sweep is printed as json:
+python headless.py --address GPIB0::24 --mode ivt --start 0 --end 1 --points 101 --dt 0.05 --out /data --name cell1
+python headless.py --recipe nightly.json --sweeps 10 --recovery 60
+give several addresses (comma separated, or auto for every 2400 on the bus) to run the recipe on all of them at
+once (see multiInstrument.py)
+"""
+from multiprocessing import freeze_support
+freeze_support()
+import sys
+import json
+import signal
+import argparse
+
+from gpib import gpib
+from acquisition import acquisition, defaultRecipe
+from multiInstrument import multiInstrument, findSourcemeters
+from dataWriters import jsonParameters
+
+#recipe key: (command line option, type, help)
+recipeOptions = [('mode', '--mode', str, "'ivt' for I,V vs t (default) or 'iv' for I vs V"),
+                 ('source', '--source', str, "'voltage' (default) or 'current'"),
+                 ('start', '--start', float, 'sweep start in V or A'),
+                 ('end', '--end', float, 'sweep end in V or A'),
+                 ('points', '--points', int, 'number of sweep points'),
+                 ('dt', '--dt', float, 'seconds per sweep point (the most with --auto-advance)'),
+                 ('minDwell', '--min-dwell', float, 'with --auto-advance, the fewest seconds per sweep point'),
+                 ('nplc', '--nplc', float, 'integration time in power line cycles'),
+                 ('average', '--average', int, 'readings averaged per measurement, 0 for none'),
+                 ('compliance', '--compliance', float, 'compliance in A (or V when sourcing current)'),
+                 ('burstReadings', '--burst', int, 'readings per buffered burst in I,V vs t mode, 0 for one per bus transaction'),
+                 ('samplesPerStep', '--hardware', int, 'in I,V vs t mode, have the 2400 step through the sweep from its source list taking this many readings per step'),
+                 ('area', '--area', str, 'device area in cm^2'),
+                 ('sweeps', '--sweeps', int, 'number of sweeps to do back to back'),
+                 ('recovery', '--recovery', float, 'seconds to wait between sweeps'),
+                 ('outputDir', '--out', str, 'folder to save into'),
+                 ('name', '--name', str, 'file name prefix'),
+                 ('format', '--format', str, "'csv' or 'npy'")]
+#recipe key: (command line option, help) for the on/off ones
+recipeFlags = [('autoZero', '--auto-zero', 'auto zero before every reading'),
+               ('fourWire', '--four-wire', '4 wire (remote sense) measurements'),
+               ('rearTerminals', '--rear', 'use the rear terminals'),
+               ('autoAdvance', '--auto-advance', 'move on from each I,V vs t point once the reading has settled'),
+               ('session', '--session', 'save all the sweeps into one .session file')]
+
+#the recipe to run: defaults, then the recipe file, then whatever was given on the command line
+def buildRecipe(args):
+    recipe = dict(defaultRecipe)
+    if args.recipe is not None:
+        with open(args.recipe, 'r') as f:
+            fromFile = json.load(f)
+        unknown = [key for key in fromFile if key not in defaultRecipe and key != 'address']
+        if unknown:
+            raise ValueError('Unknown recipe keys in {0:s}: {1:s}'.format(args.recipe, ', '.join(unknown)))
+        recipe.update(fromFile)
+    for key, option, kind, help in recipeOptions:
+        if getattr(args, key) is not None:
+            recipe[key] = getattr(args, key)
+    for key, option, help in recipeFlags:
+        if getattr(args, key):
+            recipe[key] = True
+    if recipe['mode'] not in ('ivt', 'iv'):
+        raise ValueError("mode must be 'ivt' or 'iv'")
+    if recipe['source'] not in ('voltage', 'current'):
+        raise ValueError("source must be 'voltage' or 'current'")
+    if recipe['format'] not in ('csv', 'npy'):
+        raise ValueError("format must be 'csv' or 'npy'")
+    return recipe
+
+def log(message):
+    sys.stderr.write(message + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description='Run I-V sweeps without the GUI.')
+    parser.add_argument('--address', default=None, help='instrument location string, several comma separated or auto for every 2400 found (default: GPIB0::24)')
+    parser.add_argument('--recipe', default=None, help='json file with recipe keys, command line options override it')
+    for key, option, kind, help in recipeOptions:
+        parser.add_argument(option, dest=key, type=kind, default=None, help=help)
+    for key, option, help in recipeFlags:
+        parser.add_argument(option, dest=key, action='store_true', help=help)
+    parser.add_argument('--ring', action='store_true', help='move the I,V vs t readings through shared memory instead of the done queue')
+    args = parser.parse_args()
+
+    try:
+        recipe = buildRecipe(args)
+    except (IOError, ValueError) as e:
+        parser.error(str(e))
+    fileAddress = recipe.pop('address', None) #a recipe file can say which instrument(s) it's for
+    address = args.address or fileAddress or 'GPIB0::24'
+    if address == 'auto':
+        addresses = findSourcemeters()
+        if not addresses:
+            log('No sourcemeters found')
+            return 1
+    else:
+        addresses = [a.strip() for a in address.split(',')]
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN) #so the gpib worker processes don't get ctrl-c
+    if len(addresses) > 1:
+        runner = multiInstrument(addresses, log, args.ring)
+        stations = runner.stations
+    else:
+        k = gpib(addresses[0], useQueues=True, timeout=None, useRing=args.ring)
+        station = acquisition(k, log)
+        stations = [station]
+    def stop(signum, frame): #finish the sweep that's going and save it
+        log('Stopping')
+        for s in stations:
+            s.stop()
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    try:
+        if len(addresses) > 1:
+            report = runner.run(recipe)
+        else:
+            station.setup(recipe)
+            results = station.runRecipe(recipe)
+            report = {'address': addresses[0], 'recipe': recipe,
+                      'sweeps': [{'file': path, 'parameters': jsonParameters(parameters)}
+                                 for path, parameters in results]}
+    finally:
+        if len(addresses) > 1:
+            runner.close()
+        else:
+            k.__del__()
+    print(json.dumps(report, indent=4, sort_keys=True))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -10,33 +10,43 @@ freeze_support()
 import os, sys, inspect
 
 try:
-    from gpib import gpib
+    from gpib import gpib, gpibError
     gotGPIB = True
 except:
     gotGPIB = False
     print "Could not import GPIB"
+    gpibError = Exception
 
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 import math
-from PyQt4.QtCore import QString, QThread, pyqtSignal, QTimer, QSettings, QTemporaryFile, QIODevice
+from PyQt4.QtCore import QString, QThread, pyqtSignal, QTimer, QSettings, QIODevice
 from PyQt4.QtGui import QApplication, QDialog, QMainWindow, QFileDialog, QMessageBox
 from ivSweeperUI import Ui_IVSweeper
 from collections import OrderedDict
 
-from scipy import optimize
-
 import numpy as np
 import time
 import struct
-
-#read one measurement value from queue
-def qBinRead(q):
-
+from timing import monotonic
+from dataWriters import openSweepFile, sweepFields, streamingCsvWriter, bufferedWriter
+from mppt import mpptTracker, trackingStopped, trackerColumns
+from sessionStore import sessionWriter
+from ivAnalysis import sweepStats, transientStats
+from acquisition import stepSweep, stepSweepAdaptive, listSweep, readingTime, listStepTime, requestReadings, collectReadings, readIVSweep, \
+    saveSweepExtras, sweepSettling, instrumentDefaults, burstCommands, burstOffCommands, pipelineDepth, \
+    burstPipelineDepth, listLimit
+
+try: #the live data view needs matplotlib
+    from livePlot import minMaxDecimator, livePlotWindow
+    gotLivePlot = True
+except ImportError:
+    gotLivePlot = False
+
+#unpack one measurement value read from the instrument
+def binRead(qItem):
     nElements = 4 #this needs to match the :format:elements setting in the device or else you're gonna have a bad time
     formatString = '>{0}f'.format(nElements)
-    #this is raw binary data form the instrument
-    qItem = q.get()
 
     #here we unpack the binary data from the instrument, the first two bytes are the header, '#0' we ignore those.
     #Next we have each of our four measurement values in IEEE-754 single precision data format (32 data bits)
@@ -45,17 +55,23 @@ def qBinRead(q):
 
     return (data)
 
-
-
 #here we have the thread that generates the commands that advance the source value during the sweep
 class sweepThread(QThread):
     updateProgress = pyqtSignal(float)
     sweepComplete = pyqtSignal() #indicates sweep is complete
-
-    def __init__(self, q, parent=None):
+    listDone = pyqtSignal(int) #in hardware timed mode, signal how many data points (queue items) need to be collected
+    stepLog = pyqtSignal(np.ndarray) #setpoint, scheduled time and actual issue time of each step of a software paced sweep
+    hardwareTimed = False #let the 2400 step through the sweep points from its source list instead of pacing them from here
+    samplesPerStep = 10 #in hardware timed mode, readings taken (evenly spaced) at each sweep point
+    listLimit = listLimit #the 2400's source list holds at most 100 points
+    options = {} #worker options for the data requests, {'dest': 'ring'} sends readings through shared memory
+    settling = None #settlingDetector the reader feeds, when set each step lasts until it says the reading has settled instead of dt
+
+    def __init__(self, q, credits, parent=None):
         QThread.__init__(self, parent)
 
         self.q = q #gpib command queue
+        self.credits = credits #gpib semaphore the worker releases each time it finishes one of our requests
 
         #self.prematureTermination = False
 
@@ -67,29 +83,42 @@ class sweepThread(QThread):
     #def earlyKill(self):
     #    self.prematureTermination = True
 
+    #stop sending source list chunks in hardware timed mode
+    def stopList(self):
+        self.stopListNow = True
+
+    #the stepping itself is done by the loops in acquisition.py, the same ones headless runs use
     def run(self):
-        i = float(0)
-        nPoints = len(self.sweepPoints)
+        source = str(self.sourceName)
         self.updateProgress.emit(0)
-        #autozero once before the sweep to prevent zero point drift
-        self.q.put(('write',(':system:azero once',)))
-        for point in self.sweepPoints:
-            i = i + 1
-            self.q.put(('write',(':source:' + str(self.sourceName) + ' {0:.4f}'.format(point),)))
-            time.sleep(self.dt)
-            self.updateProgress.emit(i/nPoints*100)
-            #if self.prematureTermination: #sweep termination only has time resolution of dt, oh well
-            #    break
+        if self.hardwareTimed: #the 2400 steps through the sweep points from its source list (see acquisition.listSweep)
+            self.stopListNow = False
+            nChunks = listSweep(self.q, self.credits, self.sweepPoints, self.dt, source, self.samplesPerStep, self.options,
+                                self.listLimit, self.updateProgress.emit, lambda: self.stopListNow)
+            self.updateProgress.emit(100)
+            self.listDone.emit(nChunks)
+        elif self.settling is not None: #intelligent advance, each step lasts until the readings have settled
+            log, nSettled, took = stepSweepAdaptive(self.q, self.sweepPoints, source, self.settling, self.updateProgress.emit)
+            print "Intelligent advance: {0:d} of {1:d} points settled before the max dwell, sweep took {2:.2f} s".format(nSettled, len(self.sweepPoints), took)
+            self.stepLog.emit(log)
+        else: #each step goes out at its own absolute deadline so timing errors don't pile up over the sweep
+            log = stepSweep(self.q, self.sweepPoints, self.dt, source, self.updateProgress.emit)
+            self.updateProgress.emit(100)
+            self.stepLog.emit(log)
         self.sweepComplete.emit()
-        #self.prematureTermination = False
 
 #here we have the thread that generates the measurement request commands
 class measureThread(QThread): 
-    measureDone = pyqtSignal(int) #signal how many data points need to be collected
-    def __init__(self, q, parent=None):
+    measureDone = pyqtSignal(int) #signal how many data points (queue items) need to be collected
+    burstReadings = 0 #readings per on-instrument buffered burst, 0 means one reading per bus transaction
+    options = {} #worker options for the data requests, {'dest': 'ring'} sends readings through shared memory
+    pipelineDepth = pipelineDepth #data requests kept outstanding at the worker
+    burstPipelineDepth = burstPipelineDepth #bursts kept outstanding, any more would hold up the sweep thread's source changes
+    def __init__(self, q, credits, parent=None):
         QThread.__init__(self, parent)
 
         self.q = q #gpib command queue
+        self.credits = credits #gpib semaphore the worker releases each time it finishes one of our requests
 
         self.finishUpNow = False
 
@@ -97,26 +126,31 @@ class measureThread(QThread):
         self.finishUpNow = True
 
     def run(self):
-        dataPoints = 1
-        self.q.put(('read_raw',()))
-        while not self.finishUpNow: #keep spamming read requests unless it's time to die (sweep is complete)
-            time.sleep(0.001)#only do the queue check only every millisecond to prevent pegging the CPU in this loop
-            if self.q.qsize()<5: #keep ~5 measurement requests in the task queue at all times, this is a small enough number to keep things snappy on termination, and large enough to ensure a measurement request is always queued
-                self.q.put(('read',()))#TODO: is read_raw better here?
-                dataPoints = dataPoints + 1
+        self.finishUpNow = False
+        if self.burstReadings > 0:
+            depth = self.burstPipelineDepth
+        else:
+            depth = self.pipelineDepth
+        #keep spamming read requests unless it's time to die (sweep is complete), see acquisition.requestReadings
+        dataPoints = requestReadings(self.q, self.credits, self.burstReadings, lambda: self.finishUpNow, depth, self.options)
         self.finishUpNow = False
         self.measureDone.emit(dataPoints) #here we signal how many data points will need to be collected
 
 class postProcessThread(QThread):
     sweepUp = True
     area = ''
-    tempFile = ''
     saveTime = False
     savePath = ''
+    fileFormat = 'csv' #'csv' or 'npy' (float32 .npy with a json sidecar for the header)
+    session = None #sessionWriter to add the sweep to instead of writing a file of its own
+    settings = {} #sweep settings saved along with it in a session
     readyToProcess = pyqtSignal() #signal when we're ready to post process
     postProcessingComplete = pyqtSignal() #signal when we're ready to post process
     debug = True
     rawData = []
+    streamed = None #(sweepStats, writer, transientStats) for data that was already saved as it came in
+    savedFile = ''
+    stepLog = None
     def __init__(self, parent=None):
         QThread.__init__(self, parent)
 
@@ -124,85 +158,150 @@ class postProcessThread(QThread):
         self.rawData = data
         self.readyToProcess.emit()
 
+    #I,V vs t data gets written while the sweep runs, here we just get the summary and where it went
+    def acceptStream(self,streamed):
+        self.streamed = streamed
+        self.readyToProcess.emit()
+
+    #when each step of the sweep was issued, saved next to the data
+    def acceptStepLog(self,log):
+        self.stepLog = log
+
     def run(self):
-        self.tempFile.open()
-        self.tempFile.close()
-        tempFileName = str(self.tempFile.fileName())
-        v = self.rawData[:,0]
-        i = self.rawData[:,1]
-        t = self.rawData[:,2]
-        pmaxRaw = np.max(v*i)
-        t = t - t[0] #zero time offset
-        #print t[-1]
-        diffs = np.diff(t)
-        meandt = np.mean(diffs)
-        maxdt = np.max(diffs)
-        mindt = np.min(diffs)
-        
-        
-        hdr = 'Area = {0:s} [cm^2]\n'.format(self.area)
-        hdr = hdr + 'I&V vs t = {0:b}\n'.format(self.saveTime)
-        hdr = hdr + 'sweepUp = {0:b}\n'.format(self.sweepUp)
-        if not self.saveTime:#only save iv data
-            hdr = hdr+'Voltage [V],Current [A]'
-            self.rawData = self.rawData[:,(0,1)]
-        else:
-            hdr = hdr+'Voltage [V],Current [A],Time[s],Status'
-        np.savetxt(tempFileName, self.rawData, delimiter=",",header=hdr)
-        saveDestination = self.savePath+'_'+str(int(time.time()))+'.csv'
-        self.tempFile.copy(saveDestination)
-        self.tempFile.remove()
-        
-        parameters = {'00_nSamples': len(t), \
-                      '01_pMaxRaw[mW]': pmaxRaw*1000, \
-                      '02_worstSpeed[Hz]': 1/maxdt, \
-                      '03_worstSpeed[ms]':  maxdt*1000, \
-                      '04_bestSpeed[Hz]': 1/mindt, \
-                      '05_bestSpeed[ms]':  mindt*1000, \
-                      '06_meanSpeed[Hz]': 1/meandt, \
-                      '07_meanSpeed[ms]':  meandt*1000}
+        if self.streamed is not None: #already on disk
+            stats, writer, transients = self.streamed
+        else: #I vs V data shows up all at once when the sweep is done
+            if self.session is not None:
+                writer = self.session.newSweep(sweepFields(self.area, self.saveTime, self.sweepUp), self.settings)
+            else:
+                writer = openSweepFile(self.savePath, self.fileFormat, self.area, self.saveTime, self.sweepUp)
+            writer.append(self.rawData)
+            writer.close()
+            stats = sweepStats()
+            stats.update(self.rawData)
+            transients = None
+        self.savedFile = writer.path
+
+        #the step log, the per step summary worked out as the data came in and the solar cell figures of merit (from
+        #the settled value of each step or the I vs V data) get saved next to the data
+        curve = (self.rawData[:,0], self.rawData[:,1]) if len(self.rawData) > 0 else None
+        parameters = stats.parameters()
+        parameters.update(saveSweepExtras(writer.stem, self.stepLog if self.saveTime else None, transients, curve, self.area))
+        self.stepLog = None
         if self.debug:
             pp.pprint(parameters)
         self.rawData = []
+        self.streamed = None
         self.postProcessingComplete.emit()
         
         
 class ivDataThread(QThread):
     rawData = []
     postData = pyqtSignal(np.ndarray) #send away the data collected here
-    def __init__(self, taskQ, doneQ, parent=None):
+    def __init__(self, k, parent=None):
         QThread.__init__(self, parent)
-        self.taskQ = taskQ#gpib done queue
-        self.doneQ = doneQ#gpib done queue
+        self.k = k#gpib object, the sweep's readings come back through a request future
     def run(self):
-        self.taskQ.put(('read_values',()))
-        rawData = np.array(self.doneQ.get())
-        self.postData.emit(rawData.reshape((-1,4)))
+        try:
+            rawData = readIVSweep(self.k)
+        except gpibError as e: #the sweep got aborted
+            print "I vs V sweep failed: {0:s}".format(str(e))
+            return
+        self.postData.emit(rawData)
 
 class readRealTimeDataThread(QThread):
-    rawData = []
     pointsToCollect = np.inf
-    postData = pyqtSignal(np.ndarray) #send away the data collected here
-    def __init__(self, q, parent=None):
+    writer = None #streamingCsvWriter, streamingNpyWriter or session sweep the readings are saved to as they come in, set this before each sweep
+    postStream = pyqtSignal(object) #(sweepStats, writer, transientStats) once all the data is saved
+    livePlot = None #minMaxDecimator for the live data view, readings go into it too when it's set
+    settling = None #settlingDetector for intelligent advance sweeps, readings go into it too when it's set
+    transients = None #transientStats for the sweep, set this before each sweep to get a per step summary saved with it
+    def __init__(self, q, ring=None, parent=None):
         QThread.__init__(self, parent)
         self.q = q#gpib done queue
+        self.ring = ring#gpib shared memory ring buffer, if the readings come that way
+        self.ringBlocks = 0#transactions taken out of the ring so far
     def updatePoints(self,nPoints):
         self.pointsToCollect = nPoints
-    def run(self):
-        self.rawData = []
-        collected = 0
-        while True:
-            newData = qBinRead(self.q)
-            self.rawData.append(newData)
-            collected = collected + 1
-            if collected >= self.pointsToCollect:
-                break
+    #readings go straight to disk and into the running statistics, nothing piles up in memory
+    def saveBlock(self,data,stats):
+        self.writer.append(data)
+        stats.update(data)
+        if self.transients is not None:
+            self.transients.update(data)
+        if self.settling is not None:
+            self.settling.update(data)
+        livePlot = self.livePlot #it can be switched off from the gui thread at any time
+        if livePlot is not None:
+            livePlot.append(data)
 
+    def run(self):
+        stats = sweepStats()
+        #see acquisition.collectReadings, pointsToCollect gets set when the requests stop
+        collected, notData = collectReadings(self.q, lambda data: self.saveBlock(data,stats), lambda: self.pointsToCollect,
+                                             self.ring, self.ringBlocks)
+        if self.ring is not None:
+            self.ringBlocks = self.ringBlocks + collected
+
+        if notData > 0:
+            print "Skipped {0:d} items from the instrument that weren't binary readings".format(notData)
         self.pointsToCollect = np.inf
-        if (len(self.rawData) >2):
-            arrayData = np.array(self.rawData)
-            arrayData = arrayData[arrayData[:,2].argsort()]
-            self.postData.emit(arrayData)
+        self.writer.close()
+        if isinstance(self.writer, bufferedWriter):
+            bufferStats = self.writer.stats()
+            if bufferStats['delayedBlocks'] or bufferStats['droppedBlocks'] or bufferStats['spilledRows']:
+                print "Disk fell behind: {0:s}".format(str(dict(bufferStats)))
+        self.postStream.emit((stats,self.writer,self.transients))
+
+#here we have the thread that tracks the max power point in the background
+class maxPowerThread(QThread):
+    newReading = pyqtSignal(np.ndarray) #time, setpoint, voltage, current, power, efficiency (see mppt.trackerColumns)
+    timeout = 10 #seconds to wait for a reading before giving up
+    updateProgress = pyqtSignal(float)
+    trackingDone = pyqtSignal()
+    tracker = None #mpptTracker to run, set this up before starting (its measure function is our measure)
+    writer = None #streamingCsvWriter the readings get saved to as they come in
+    sourceName = 'voltage'
+    dt = 1 #seconds to dwell at the max power point (measuring all the while) between trackings
+    nCycles = 1
+    def __init__(self, k, parent=None):
+        QThread.__init__(self, parent)
+        self.k = k #gpib object, readings come back through its request futures so nothing else can take them
+        self.q = k.task_queue #gpib command queue
+
+    #set the source and take a reading there
+    def measure(self, setpoint):
+        self.q.put(('write',(':source:' + str(self.sourceName) + ' {0:.4f}'.format(setpoint),)))
+        return binRead(self.k.request('read_raw').result(self.timeout))
+
+    def stop(self):
+        if self.tracker is not None:
+            self.tracker.stop()
+
+    def run(self):
+        self.updateProgress.emit(0)
+        try:
+            for cycle in range(self.nCycles):
+                self.tracker.update()
+                self.q.put(('write',(':system:key 23',))) #go into local mode for live display update
+                dwellEnd = monotonic() + self.dt
+                while True: #readings as fast as the instrument gives them until it's time to look for the max power point again
+                    if self.tracker.continuous: #the local algorithms follow the max power point between readings too
+                        self.tracker.update()
+                    row = self.tracker.reading()
+                    self.writer.append(row.reshape((1,-1)))
+                    self.newReading.emit(row)
+                    if monotonic() >= dwellEnd:
+                        break
+                self.updateProgress.emit(float(cycle+1)/self.nCycles*100)
+        except trackingStopped:
+            pass
+        except gpibError as e:
+            print "Max power point tracking stopped: {0:s}".format(str(e))
+        finally: #whatever went wrong, save what we got and give the gui back its buttons
+            print "MPPT measurement cache: {0:s}".format(str(self.tracker.cache.stats()))
+            self.writer.close()
+            self.trackingDone.emit()
             
 #here we have the thread that searches the bus for instruments
 class instrumentDetectThread(QThread):
@@ -223,6 +322,25 @@ class MainWindow(QMainWindow):
     #killSweepNow = pyqtSignal()
     sweepUp = True
     userWantsOn = False #the user wants the output off
+    useRing = False #move I,V vs t readings from the gpib worker process through shared memory instead of the done queue
+    hardwareTimed = False #in I,V vs t mode have the 2400 step through the sweep from its source list (see acquisition.listSweep)
+    samplesPerStep = 10 #readings the 2400 takes at each point of a hardware timed sweep
+    continualSession = False #in continual sweep mode, save all the sweeps into one indexed session file (see sessionStore.py)
+    session = None #the sessionWriter for the continual sweep run going on now
+    tracking = False #the max power point tracker is running
+    mpptAlgorithm = 'perturbObserve' #max power point tracking algorithm, one of mppt.mpptTracker.algorithms ('cobyla' is the slow original)
+    outputFormat = 'csv' #'npy' saves sweeps as float32 .npy files (header fields in a .json next to each) instead of text
+    writeBufferRows = 1<<20 #I,V vs t readings (16 bytes each) that can wait in memory for the disk
+    writePolicy = 'block' #when they can't: 'block' holds up the data path, 'drop' loses readings, 'spill' puts them in a temporary file
+    minDwell = 0.05 #with intelligent advance, the shortest a step can be (s), the delay setting is the longest
+    lineFrequency = 60.0 #Hz, asked of the instrument on connect
+    speedNplc = [0.01, 0.1, 1, 10] #nplcycles setSpeed sends for each speedCombo setting
+    burstReadings = 0 #in I,V vs t mode take this many readings per trigger into the 2400's buffer and fetch them in one block (keep the burst well under the step delay), 0 to read one point per bus transaction
+    #the options up here with no control of their own get read from the settings file on start and written back to it on
+    #exit, so they can be changed there (~/.config/greyltc/ivSweeper.conf on linux) instead of here
+    storedOptions = [('outputFormat', str, ['csv', 'npy']), ('continualSession', bool, None), ('burstReadings', int, None),
+                     ('useRing', bool, None), ('hardwareTimed', bool, None), ('samplesPerStep', int, None),
+                     ('writePolicy', str, bufferedWriter.policies)]
     def __init__(self):
         QMainWindow.__init__(self)
         
@@ -249,6 +367,7 @@ class MainWindow(QMainWindow):
         
         if self.settings.contains('lastFolder'):
             self.ui.dirEdit.setText(self.settings.value('lastFolder').toString())          
+        self.loadStoredOptions()
 
         #connect signals generated by gui elements to proper functions        
         self.ui.sweepButton.clicked.connect(self.manageSweep)
@@ -265,6 +384,8 @@ class MainWindow(QMainWindow):
         self.ui.outputCheck.toggled.connect(self.setOutput)
         self.ui.delaySpinBox.valueChanged.connect(self.updateDeltaText)
         self.ui.totalPointsSpin.valueChanged.connect(self.updateDeltaText)
+        self.ui.speedCombo.currentIndexChanged.connect(self.updateDeltaText)
+        self.ui.averageSpin.valueChanged.connect(self.updateDeltaText)
         self.ui.reverseButton.clicked.connect(self.reverseCall)
         self.ui.actionRun_Test_Code.triggered.connect(self.testArea)
         self.ui.instrumentCombo.activated.connect(self.handleICombo)
@@ -273,9 +394,30 @@ class MainWindow(QMainWindow):
         self.ui.browseButton.clicked.connect(self.browseButtonCall)
         self.ui.outputCheck.clicked.connect(self.toggleWhatUserWants)
 
+        #the live data view shows the I,V vs t readings as they come in
+        self.livePlotWindow = None
+        self.ui.livePlotCheck.setEnabled(gotLivePlot)
+        self.ui.livePlotCheck.toggled.connect(self.setLivePlot)
+
+        #intelligent advance moves on from each I,V vs t sweep point once the reading has settled
+        self.ui.autoAdvance.setEnabled(True)
+
         #TODO: load state here
         #self.restoreState(self.settings.value('guiState').toByteArray())
         
+    #show or hide the live data view, it starts empty every time it's shown
+    def setLivePlot(self, show):
+        if show:
+            if self.livePlotWindow is None:
+                self.livePlotWindow = livePlotWindow(minMaxDecimator())
+                self.livePlotWindow.closed.connect(lambda: self.ui.livePlotCheck.setChecked(False))
+            self.livePlotWindow.decimator.clear()
+            self.livePlotWindow.show()
+        elif self.livePlotWindow is not None:
+            self.livePlotWindow.hide()
+        if hasattr(self, 'readRealTimeDataThread'):
+            self.readRealTimeDataThread.livePlot = self.livePlotWindow.decimator if show else None
+
     #this keeps track of clicks on the output/on off box
     def toggleWhatUserWants(self):
         self.userWantsOn = not self.userWantsOn
@@ -346,70 +488,92 @@ class MainWindow(QMainWindow):
         self.settings.setValue('lastFolder',dirName)
         self.ui.dirEdit.setText(dirName)
 
-    #return -1 * the power of the device at a given voltage or current
-    def invPower(self,request):
-        request = request[0]
-        
-        #TODO: remove this testing current fudge value
-        #currentFudge = 0.004;
-        currentFudge = 0;
-        
-        try:
-            print request
-            self.sendCmd('source:'+self.source+' {0:.3f}'.format(request))
-            self.k.task_queue.put(('read_raw',())) #TODO: this should be split to another function
-            data = qBinRead(self.k.done_queue)
-            return (data[0]*(data[1]-currentFudge))
-        except:
-            self.ui.statusbar.showMessage("Error: Not connected",self.messageDuration);
-            return np.nan
-
-
     def handleShutter(self):
         shutterOnValue = '14'
         shutterOffValue = '15'
-        self.k.task_queue.put(('ask',(':source2:ttl:actual?',))) #TODO: this should be split to another function
-        outStatus = self.k.done_queue.get()
+        try:
+            outStatus = self.k.ask(':source2:ttl:actual?',10)
+        except (gpibError, AttributeError):
+            self.ui.statusbar.showMessage("Error: Not connected",self.messageDuration)
+            return
         if outStatus == shutterOnValue:
             self.sendCmd(":source2:ttl " + shutterOffValue)
         else:
             self.sendCmd(":source2:ttl " + shutterOnValue)
     
-    #TODO: move this to its own thread
+    #start tracking the max power point in the background, the sweep points box sets how many times it gets
+    #relocated and the delay box how long we dwell there (saving readings) in between
     def maxPowerDwell(self):
         voltageSourceRange = 3 # operate between +/- 3V
         currentSourceRange = 0.1 # operate between +/- 100ma
         if self.sourceUnit == 'V': 
-            self.sendCmd(':source:'+self.source+':range {0:.3f}'.format(voltageSourceRange))
             initialGuess = 0.7
+            stepSize = 0.005
         else:
-            self.sendCmd(':source:'+self.source+':range {0:.3f}'.format(currentSourceRange))
             initialGuess = 0.01 # no idea if this is right
+            stepSize = 0.0001
 
+        area = str(self.ui.deviceAreaEdit.text())
+        try:
+            tracker = mpptTracker(self.maxPowerThread.measure, area, initialGuess, self.mpptAlgorithm, stepSize)
+        except ValueError:
+            self.ui.statusbar.showMessage("Enter the device area first",self.messageDuration)
+            return
         dt = self.ui.delaySpinBox.value()
-        nPoints = float(self.ui.totalPointsSpin.value())
-        
+        savePath = os.path.join(str(self.ui.dirEdit.text()),str(self.ui.fileEdit.text()))
+        hdr = 'Area = {0:s} [cm^2]\nMax power point tracking, dwell = {1:.3f} s\n'.format(area, dt) + ','.join(trackerColumns)
+        try:
+            self.maxPowerThread.writer = streamingCsvWriter(savePath+'_'+str(int(time.time()))+'_mpp.csv', hdr)
+        except IOError:
+            self.ui.statusbar.showMessage("Could not create output file",self.messageDuration)
+            return
+
+        if self.sourceUnit == 'V': 
+            self.sendCmd(':source:'+self.source+':range {0:.3f}'.format(voltageSourceRange))
+        else:
+            self.sendCmd(':source:'+self.source+':range {0:.3f}'.format(currentSourceRange))
+        if self.ui.saveModeCombo.currentIndex() == 1: #one reading per trigger at a fixed source value
+            self.sendCmd(':source:'+self.source+':mode fixed')
+            self.sendCmd(':trigger:count 1')
         self.ui.outputCheck.setChecked(True)
-        oldSpeedIndex = self.ui.speedCombo.currentIndex()
+        self.oldSpeedIndex = self.ui.speedCombo.currentIndex()
         self.ui.speedCombo.setCurrentIndex(2)
-        
-        
-        for i in range(int(nPoints)):
-            optResults = optimize.minimize(self.invPower,initialGuess,method='COBYLA',tol=1e-4,options={'rhobeg':0.2})
-            print optResults.message
-            print optResults.status
-            answer = float(optResults.x)
-            initialGuess = answer
-            self.sendCmd(":SYST:KEY 23") #go into local mode for live display update
-            print "Optimized! Mpp Voltage: {0:.3f}".format(answer)
-            print "Now sleeping for {0:.1f} seconds".format(dt)
-            time.sleep(dt)
-            self.k.task_queue.put(('read_raw',()))
-            data = qBinRead(self.k.done_queue)        
-            #vi = (data[0], data[1], data[1]*data[0]*1000/.4*-1)
-            print 'Max Power: {0:.3f}% '.format(data[0]*data[1]*1000/float(self.ui.deviceAreaEdit.text()))
+
+        self.enableControls(False)
+        self.tracking = True
+        self.maxPowerThread.tracker = tracker
+        self.maxPowerThread.sourceName = self.source
+        self.maxPowerThread.dt = dt
+        self.maxPowerThread.nCycles = int(self.ui.totalPointsSpin.value())
+        self.maxPowerThread.start()
+        self.ui.sweepButton.setText('Stop Tracking')
+
+    def showTrackerReading(self, row):
+        self.ui.statusbar.showMessage("Mpp {0:s}: {1:.3f}, Power: {2:.3f} mW, Efficiency: {3:.2f}%".format(self.sourceUnit, row[1], row[4]*1000, row[5]))
+
+    #put things back once the max power point tracker stops
+    def maxPowerComplete(self):
+        self.tracking = False
+        self.ui.progress.setValue(0)
+        self.enableControls(True)
+        self.ui.sweepButton.setText('Start Sweep')
+        self.ui.sweepButton.setEnabled(True)
         self.ui.outputCheck.setChecked(self.userWantsOn)
-        self.ui.speedCombo.setCurrentIndex(oldSpeedIndex)
+        self.ui.speedCombo.setCurrentIndex(self.oldSpeedIndex)
+        if self.ui.saveModeCombo.currentIndex() == 1: #back to sweeping
+            self.sendCmd(':source:'+self.source+':mode sweep')
+            self.sendCmd(':trigger:count {0:d}'.format(int(self.ui.totalPointsSpin.value())))
+
+    #lock the settings (False) while something's running, unlock them (True) when it's done
+    def enableControls(self, enabled):
+        self.ui.terminalsGroup.setEnabled(enabled)
+        self.ui.wiresGroup.setEnabled(enabled)
+        self.ui.modeGroup.setEnabled(enabled)
+        self.ui.complianceGroup.setEnabled(enabled)
+        self.ui.sweepGroup.setEnabled(enabled)
+        self.ui.daqGroup.setEnabled(enabled)
+        self.ui.outputCheck.setEnabled(enabled)
+        self.ui.addressGroup.setEnabled(enabled)
 
     def testArea(self):
         print('Running test code now')
@@ -418,10 +582,31 @@ class MainWindow(QMainWindow):
         #x = np.random.randn(10000)
         #np.hist(x, 100)        
 
+    #take the storedOptions that are in the settings file, ones that aren't among their choices are left alone
+    def loadStoredOptions(self):
+        for name, kind, choices in self.storedOptions:
+            if not self.settings.contains(name):
+                continue
+            value = self.settings.value(name)
+            if kind is bool:
+                value = value.toBool()
+            elif kind is int:
+                value = value.toInt()[0]
+            else:
+                value = str(value.toString())
+            if choices is None or value in choices:
+                setattr(self, name, value)
+            else:
+                print "Ignoring {0:s}={1:s} from the settings file, it should be one of {2:s}".format(name, value, str(choices))
+
     def closeEvent(self,event):
         #TODO: save state here
         #self.settings.setValue('guiState',self.saveState())
+        for name, kind, choices in self.storedOptions:
+            self.settings.setValue(name, getattr(self, name))
         self.closeInstrument()
+        if self.livePlotWindow is not None:
+            self.livePlotWindow.close()
         QMainWindow.closeEvent(self,event)
 
     #do these things when a sweep completes (or is canceled by the user)
@@ -463,6 +648,9 @@ class MainWindow(QMainWindow):
             
             self.ui.outputCheck.setChecked(self.userWantsOn)
             self.sendCmd(':source:' + self.source + ' {0:.4f}'.format(float(self.ui.startSpin.value())/1000))
+            if self.ui.saveModeCombo.currentIndex() == 0 and self.burstReadings > 0: #back to one reading per trigger
+                for cmd in burstOffCommands:
+                    self.sendCmd(cmd)
             #self.sendCmd(":SYST:KEY 23")
         
     #update progress bar
@@ -497,6 +685,41 @@ class MainWindow(QMainWindow):
             
     def initiateNewSweep(self):
         if self.ui.saveModeCombo.currentIndex() == 0: #this is an I,V vs t sweep
+            #I,V vs t readings get saved as they come in
+            savePath = os.path.join(str(self.ui.dirEdit.text()),str(self.ui.fileEdit.text()))
+            try:
+                if self.session is not None:
+                    writer = self.session.newSweep(sweepFields(str(self.ui.deviceAreaEdit.text()), True, self.sweepUp), self.sweepSettings())
+                else:
+                    writer = openSweepFile(savePath, self.outputFormat, str(self.ui.deviceAreaEdit.text()), True, self.sweepUp)
+                #the disk gets its own thread and a bounded queue so it can't stall the reader or fill memory
+                self.readRealTimeDataThread.writer = bufferedWriter(writer, self.writeBufferRows, self.writePolicy)
+            except IOError:
+                self.ui.statusbar.showMessage("Could not create output file",self.messageDuration)
+                self.sweeping = False
+                self.doSweepComplete()
+                self.ui.sweepButton.setEnabled(True)
+                return
+            self.sweepThread.hardwareTimed = self.hardwareTimed
+            self.sweepThread.samplesPerStep = self.samplesPerStep
+            if self.hardwareTimed and self.stepTime() > self.ui.delaySpinBox.value():
+                self.ui.statusbar.showMessage('{0:d} readings per step take longer than the delay, each step will last {1:.4f} s'.format(self.samplesPerStep, self.stepTime()),self.messageDuration)
+            if self.ui.autoAdvance.isChecked() and not self.hardwareTimed: #the reader tells the sweep thread when to step
+                depth = self.measureThread.burstPipelineDepth if self.burstReadings > 0 else self.measureThread.pipelineDepth
+                settling = sweepSettling(self.source, self.minDwell, self.ui.delaySpinBox.value(), depth, self.burstReadings)
+            else:
+                settling = None
+            self.sweepThread.settling = settling
+            self.readRealTimeDataThread.transients = transientStats(self.sweepThread.sweepPoints, 1 if self.source == 'voltage' else 0)
+            self.readRealTimeDataThread.settling = settling
+            if self.hardwareTimed: #the sweep thread requests the data itself
+                self.readRealTimeDataThread.start()
+                self.sweepThread.start()
+                return
+            self.measureThread.burstReadings = self.burstReadings
+            if self.burstReadings > 0: #readings get buffered in the instrument during each burst
+                for cmd in burstCommands(self.burstReadings):
+                    self.sendCmd(cmd)
             #start sweeping and measuring
             self.readRealTimeDataThread.start()
             self.measureThread.start()
@@ -508,8 +731,11 @@ class MainWindow(QMainWindow):
     #do these things when the user presses the sweep button
     def manageSweep(self):
         
-        if self.ui.maxPowerCheck.isChecked():
-            self.maxPowerDwell() #TODO this should go into the background
+        if self.tracking: #stop the max power point tracker, it finishes up with the measurement it's on
+            self.ui.sweepButton.setEnabled(False)
+            self.maxPowerThread.stop()
+        elif self.ui.maxPowerCheck.isChecked():
+            self.maxPowerDwell()
         else:
             if not self.sweeping:
     
@@ -545,6 +771,12 @@ class MainWindow(QMainWindow):
                 #send sweep parameters to the sweep thread
                 self.sweepVaribles.emit(dt,sweepValues,self.source)
                 self.sweeping = True
+
+                if self.continualSession and self.ui.sweepContinuallyGroup.isChecked():
+                    try:
+                        self.session = sessionWriter(os.path.join(str(self.ui.dirEdit.text()),str(self.ui.fileEdit.text())))
+                    except IOError:
+                        self.ui.statusbar.showMessage("Could not create session file, saving sweeps to separate files",self.messageDuration)
                 
                 self.initiateNewSweep()
                 self.ui.sweepButton.setText('Abort Sweep')
@@ -554,11 +786,14 @@ class MainWindow(QMainWindow):
                 self.ui.statusbar.showMessage("Sweep aborted",self.messageDuration)
                 self.ui.sweepButton.setEnabled(False)
                 if hasattr(self,'timerA') and self.timerA.isActive():
+                    self.closeSession() #between sweeps, nothing more is coming
                     self.timerA.stop()
                     self.timerB.stop()
                     self.timerC.stop()
                 else:#sweep dealy tiemrs are not running, we're mid-sweep, send the kill signal
-                    if self.ui.saveModeCombo.currentIndex() == 0:# we're in I,V vs t mode
+                    if self.ui.saveModeCombo.currentIndex() == 0 and self.hardwareTimed:# the list chunks already queued finish, no more get sent
+                        self.sweepThread.stopList()
+                    elif self.ui.saveModeCombo.currentIndex() == 0:# we're in I,V vs t mode
                         self.sweepThread.terminate()
                         self.measureThread.timeToDie()
                     else: # we're in I vs V mode
@@ -576,47 +811,82 @@ class MainWindow(QMainWindow):
         
         self.postProcessThread.savePath = os.path.join(str(self.ui.dirEdit.text()),str(self.ui.fileEdit.text()))
         
-        self.postProcessThread.tempFile = QTemporaryFile()
-        
         self.postProcessThread.sweepUp = self.sweepUp
+        self.postProcessThread.fileFormat = self.outputFormat
+        self.postProcessThread.session = self.session
+        self.postProcessThread.settings = self.sweepSettings()
         
         self.postProcessThread.start()
         
     def processingDone(self):
         self.ui.sweepButton.setEnabled(True)
+        if not self.sweeping: #the last sweep of the session is saved
+            self.closeSession()
+
+    #what the sweep was run with, kept with each sweep in a session
+    def sweepSettings(self):
+        return {'source': self.source,
+                'start': float(self.ui.startSpin.value())/1000,
+                'end': float(self.ui.endSpin.value())/1000,
+                'nPoints': int(self.ui.totalPointsSpin.value()),
+                'dt[s]': float(self.ui.delaySpinBox.value()),
+                'compliance': float(self.ui.complianceSpin.value()),
+                'speed': str(self.ui.speedCombo.currentText()),
+                'average': int(self.ui.averageSpin.value()),
+                'autoZero': self.ui.zeroCheck.isChecked(),
+                'frontTerminals': self.ui.frontRadio.isChecked(),
+                'twoWire': self.ui.twowireRadio.isChecked(),
+                'hardwareTimed': self.hardwareTimed,
+                'burstReadings': self.burstReadings}
+
+    def closeSession(self):
+        if self.session is not None:
+            self.session.close()
+            self.session = None
 
     def initialSetup(self):
         try:
             #create the post processing thread and give it the keithley's done queue so that it can pull data from it
             self.postProcessThread = postProcessThread()
             
-            self.ivDataThread = ivDataThread(self.k.task_queue,self.k.done_queue)
+            self.ivDataThread = ivDataThread(self.k)
             self.ivDataThread.postData.connect(self.postProcessThread.acceptNewData)
             self.ivDataThread.postData.connect(self.doSweepComplete)                
 
             #create the measurement thread and give it the keithley's task queue so that it can issue commands to it
-            self.measureThread = measureThread(self.k.task_queue)
-            
-            #create the data reading thread and give it the keithley's done queue so that it can grab data from it
-            self.readRealTimeDataThread = readRealTimeDataThread(self.k.done_queue)
+            self.measureThread = measureThread(self.k.task_queue,self.k.credits)
 
             #create the sweep thread and give it the keithley's task queue so that it can issue commands to it
-            self.sweepThread = sweepThread(self.k.task_queue)
+            self.sweepThread = sweepThread(self.k.task_queue,self.k.credits)
+            
+            #create the data reading thread and give it the keithley's done queue so that it can grab data from it
+            if self.useRing: #or the shared memory ring buffer if the readings are coming through that
+                self.measureThread.options = {'dest': 'ring'}
+                self.sweepThread.options = {'dest': 'ring'}
+                self.readRealTimeDataThread = readRealTimeDataThread(self.k.done_queue,self.k.ring)
+            else:
+                self.readRealTimeDataThread = readRealTimeDataThread(self.k.done_queue)
+            if self.ui.livePlotCheck.isChecked():
+                self.readRealTimeDataThread.livePlot = self.livePlotWindow.decimator
 
             #self.measureThread.measureDone.connect(self.collectDataThread.catchPointNumber)
             self.measureThread.measureDone.connect(self.readRealTimeDataThread.updatePoints)
+            self.sweepThread.listDone.connect(self.readRealTimeDataThread.updatePoints)
             #self.collectDataThread.readyToCollect.connect(self.collectDataThread.start)
 
             #now connect  all the signals associated with these threads:
             #update the progress bar during the sweep
             self.sweepThread.updateProgress.connect(self.updateProgress)
 
+            #the time each step of the sweep was actually issued gets saved with the data
+            self.sweepThread.stepLog.connect(self.postProcessThread.acceptStepLog)
+
             #update gui and shut off the output only when the last data point has been collected properly
             #self.collectAndSaveDataThread.dataCollectionDone.connect(self.doSweepComplete)
 
-            #here the collected data is sent to the post processing thread
-            self.readRealTimeDataThread.postData.connect(self.postProcessThread.acceptNewData)
-            self.readRealTimeDataThread.postData.connect(self.doSweepComplete)
+            #here the post processing thread hears about the data that's been saved
+            self.readRealTimeDataThread.postStream.connect(self.postProcessThread.acceptStream)
+            self.readRealTimeDataThread.postStream.connect(self.doSweepComplete)
             
             #here the post process thread signals that it has the data and it's ready to start processing 
             self.postProcessThread.readyToProcess.connect(self.saveOutputFile)
@@ -629,31 +899,27 @@ class MainWindow(QMainWindow):
             
             self.postProcessThread.postProcessingComplete.connect(self.processingDone)
 
+            #the max power point tracker runs in its own thread and reports each reading it takes
+            self.maxPowerThread = maxPowerThread(self.k)
+            self.maxPowerThread.newReading.connect(self.showTrackerReading)
+            self.maxPowerThread.updateProgress.connect(self.updateProgress)
+            self.maxPowerThread.trackingDone.connect(self.maxPowerComplete)
+
             #kill sweep early on user request
             #self.killSweepNow.connect(self.sweepThread.earlyKill)
             #self.killSweepNow.connect(self.collectAndSaveDataThread.earlyKill)
             #TODO: should immediately stop threads and purge queue on user cancel
 
-            self.sendCmd(":format:data sreal")
-            self.sendCmd(':system:beeper:state 0') #make this quiet
-
-            #always measure current and voltage
-            self.sendCmd(':sense:function:concurrent on')
+            #binary transfers of time, voltage, current and status, quiet, concurrent current and voltage measurements,
+            #nothing stored in the buffer, repeating (not moving) averaging... (the same defaults headless runs use)
+            for cmd in instrumentDefaults:
+                self.sendCmd(cmd)
 
             self.setTerminals()
             self.setWires()
-            self.sendCmd(":trace:feed:control never") #don't ever store data in buffer
             self.setZero()
-
-            self.sendCmd(':sense:average:tcontrol repeat') #repeating averaging (not moving)
             self.setAverage()
 
-            self.sendCmd(':format:elements time,voltage,current,status') #set data measurement elements
-            self.sendCmd(':trigger:delay 0')
-            
-            self.sendCmd(':source:sweep:spacing linear')
-            self.sendCmd(':source:sweep:ranging best')
-            
             self.setMode() #sets output mode (current or voltage)
  
             self.setOutput()
@@ -671,17 +937,16 @@ class MainWindow(QMainWindow):
 
         try:
             #now that the user has selected an address for the keithley, let's connect to it. we'll use the thread safe version of the visa/gpib interface since we have multiple threads here
-            self.k = gpib(instrumentAddress,useQueues=True,timeout=None)
+            self.k = gpib(instrumentAddress,useQueues=True,timeout=None,useRing=self.useRing)
 
             #self.k.task_queue.put(('clear',()))
             #self.sendCmd(':abort')
             self.sendCmd("*rst")
             #self.sendCmd('*cls')
-            self.k.task_queue.put(('ask',('*idn?',)))
             try:
-                ident = self.k.done_queue.get(block=True,timeout=10)
+                ident = self.k.ask('*idn?',10)
                 self.ui.statusbar.showMessage("Connected to " + ident,self.messageDuration)
-            except:
+            except gpibError:
                 ident = []
 
             # let's be sure the firmware and model are what we expect (and what's tested to work)
@@ -689,9 +954,12 @@ class MainWindow(QMainWindow):
             firmwareString = "C33"
             if ident.__contains__(modelString):
                 if ident.__contains__(firmwareString):
-                    self.k.task_queue.put(('ask',(':system:mep:state?',)))
-                    isSCPI = self.k.done_queue.get()
+                    try:
+                        isSCPI = self.k.ask(':system:mep:state?',10)
+                    except gpibError:
+                        isSCPI = None
                     if isSCPI == '0':
+                        self.lineFrequency = float(self.k.ask(':system:lfrequency?',10))
                         if self.initialSetup():
                             self.ui.sweepButton.setEnabled(True)
                             self.ui.sweepButton.setFocus()
@@ -728,10 +996,14 @@ class MainWindow(QMainWindow):
 
     #tell keithely to change compliance when on gui compliance change events
     def setCompliance(self):
-        self.ui.outputCheck.setChecked(False)
         value = float(self.ui.complianceSpin.value())
-        self.sendCmd(':sense:'+self.sense+':protection {0:.3f}'.format(value/1000))
-        self.sendCmd(':sense:'+self.sense+':range {0:.3f}'.format(value/1000))
+        protectionCmd = ':sense:'+self.sense+':protection {0:.3f}'.format(value/1000)
+        rangeCmd = ':sense:'+self.sense+':range {0:.3f}'.format(value/1000)
+        if self.alreadySet(protectionCmd, rangeCmd): #don't cycle the output for nothing
+            return
+        self.ui.outputCheck.setChecked(False)
+        self.sendCmd(protectionCmd)
+        self.sendCmd(rangeCmd)
         self.ui.outputCheck.setChecked(self.userWantsOn)
 
     #tell keithely to change nplc and digits displayed when on gui speed change events
@@ -828,6 +1100,12 @@ class MainWindow(QMainWindow):
 
     #do these things just before program termination to ensure the computer and instrument are left in a friendly state
     def closeInstrument(self):
+        self.closeSession()
+        try:
+            self.maxPowerThread.stop()
+            self.maxPowerThread.wait(5000)
+        except:
+            pass
         try:
             self.sweeping = False
             self.measureThread.timeToDie()
@@ -863,13 +1141,28 @@ class MainWindow(QMainWindow):
 
 
     def setTerminals(self):
-        self.ui.outputCheck.setChecked(False)
         if self.ui.frontRadio.isChecked():
-            self.sendCmd(":route:terminals front")
+            terminalsCmd = ":route:terminals front"
         else:
-            self.sendCmd(":route:terminals rear")
+            terminalsCmd = ":route:terminals rear"
+        if self.alreadySet(terminalsCmd): #don't cycle the output for nothing
+            return
+        self.ui.outputCheck.setChecked(False)
+        self.sendCmd(terminalsCmd)
         self.ui.outputCheck.setChecked(self.userWantsOn)
 
+    #how long each sweep point really takes: the delay, plus the reading in I vs V mode, or stretched when a hardware
+    #timed step's readings don't fit in it
+    def stepTime(self):
+        dt = self.ui.delaySpinBox.value()
+        tReading = readingTime(self.speedNplc[self.ui.speedCombo.currentIndex()], self.ui.averageSpin.value(), self.lineFrequency)
+        if self.ui.saveModeCombo.currentIndex() == 1:# we're in i vs v mode
+            return dt + tReading
+        elif self.hardwareTimed:
+            return listStepTime(dt, self.samplesPerStep, tReading)
+        else:
+            return dt
+
     def updateDeltaText(self):
         #tTot = float(self.ui.totalTimeSpin.value())
         dt = self.ui.delaySpinBox.value()
@@ -877,7 +1170,7 @@ class MainWindow(QMainWindow):
         start = float(self.ui.startSpin.value())
         end = float(self.ui.endSpin.value())
         span = end-start
-        tTot = dt*nPoints
+        tTot = self.stepTime()*nPoints
         
         if self.ui.saveModeCombo.currentIndex() == 1:# we're in i vs v mode
             self.sendCmd(':trigger:count {0:d}'.format(int(nPoints)))
@@ -901,12 +1194,22 @@ class MainWindow(QMainWindow):
         self.ui.deltaStep.setText(stepText)
 
     def setWires(self):
-        self.ui.outputCheck.setChecked(False)
         if self.ui.twowireRadio.isChecked():
-            self.sendCmd(":system:rsense OFF")
+            wiresCmd = ":system:rsense OFF"
         else:
-            self.sendCmd(":system:rsense ON")
+            wiresCmd = ":system:rsense ON"
+        if self.alreadySet(wiresCmd): #don't cycle the output for nothing
+            return
+        self.ui.outputCheck.setChecked(False)
+        self.sendCmd(wiresCmd)
         self.ui.outputCheck.setChecked(self.userWantsOn)
+
+    #true when sending these wouldn't change anything on the instrument
+    def alreadySet(self, *cmds):
+        try:
+            return all([self.k.isCurrent(cmd) for cmd in cmds])
+        except AttributeError: #not connected yet
+            return False
         
     def sendCmd(self,cmdString):
         try:
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+here we have the analysis that gets done on sweep data
+
+sweepStats keeps the numbers postProcessThread reports (number of samples, raw max power and the best, worst and
+mean sample rates) up to date block by block, so they're ready at the end of a sweep without the whole sweep
+having to be kept in memory
+
+transientStats does the same for each step of an I,V vs t sweep: readings get assigned to the sweep point nearest
+their source readback, a new step starts whenever that changes, and each step keeps a few running values (min,
+max, the integral of the sensed value over time and the readings from the last settleWindow seconds), so every
+reading costs the same however long the sweep is. when a step ends its row of transientColumns is worked out from
+its tail, the last settleFraction of the step (but no more than settleWindow seconds):
+settled -- mean of the sensed value over the tail
+noise -- standard deviation of the readings over the tail
+time constant -- area between the readings and the settled value over the initial offset from it (exact for an
+    exponential approach that's finished by the end of the step). nan when the step is too short to tell: the
+    approach has to be settleTaus time constants along before the tail starts, or the tail isn't settled
+overshoot -- furthest the readings went past the settled value, coming from the side the step started on
+transients = transientStats(sweepPoints, sensedColumn=1)
+transients.update(block) #as the data comes in
+transients.table() #a row per step
+
+figuresOfMerit gets the solar cell numbers out of an I-V curve (or a whole batch of them at once, as nan padded 2D
+arrays from padCurves): Voc and Isc from interpolated zero crossings, the max power point, fill factor, series and
+shunt resistance from straight line fits to the fitPoints readings around Voc and Isc and PCE assuming 1 sun
+(100 mW/cm^2). a fill factor outside 0 to 1 or a negative resistance can't be right so they come out nan.
+currents use the sourcemeter's sign convention (a cell putting out power reads negative) but Isc, Impp
+and Pmax are given as the positive amounts the cell puts out:
+fom = figuresOfMerit(v, i, area) #for I,V vs t sweeps use the settled value of each step, transients.curve()
+saveFiguresOfMerit(path, fom) #json next to the data (what isn't there is null), sweepReader picks it up
+"""
+from collections import OrderedDict
+import numpy as np
+from dataWriters import writeJson
+
+class sweepStats:
+    def __init__(self):
+        self.nSamples = 0
+        self.pMaxRaw = -np.inf
+        self.tFirst = None
+        self.tLast = None
+        self.minDt = np.inf
+        self.maxDt = -np.inf
+
+    #take in another (n, >=3) block of voltage, current, time... rows
+    def update(self, data):
+        if len(data) == 0:
+            return
+        v = np.asarray(data[:,0], dtype=float)
+        i = np.asarray(data[:,1], dtype=float)
+        t = np.asarray(data[:,2], dtype=float)
+        self.pMaxRaw = max(self.pMaxRaw, np.max(v*i))
+        if self.tLast is None:
+            self.tFirst = t[0]
+        else:
+            t = np.concatenate(([self.tLast], t)) #so the gap between blocks counts too
+        diffs = np.diff(t)
+        if len(diffs) > 0:
+            self.minDt = min(self.minDt, np.min(diffs)) #numpy floats so a zero interval gives inf Hz, not an exception
+            self.maxDt = max(self.maxDt, np.max(diffs))
+        self.tLast = t[-1]
+        self.nSamples = self.nSamples + len(data)
+
+    #the summary postProcessThread prints
+    def parameters(self):
+        if self.nSamples < 2:
+            return {'00_nSamples': self.nSamples}
+        meandt = (self.tLast - self.tFirst)/np.float64(self.nSamples - 1)
+        return {'00_nSamples': self.nSamples, \
+                '01_pMaxRaw[mW]': self.pMaxRaw*1000, \
+                '02_worstSpeed[Hz]': 1/self.maxDt, \
+                '03_worstSpeed[ms]':  self.maxDt*1000, \
+                '04_bestSpeed[Hz]': 1/self.minDt, \
+                '05_bestSpeed[ms]':  self.minDt*1000, \
+                '06_meanSpeed[Hz]': 1/meandt, \
+                '07_meanSpeed[ms]':  meandt*1000}
+
+transientColumns = ['Setpoint', 'Start [s]', 'Duration [s]', 'Samples', 'Initial', 'Settled', 'Time Constant [s]',
+                    'Overshoot', 'Noise']
+
+class transientStats:
+    settleWindow = 0.1 #most seconds at the end of a step the settled value and noise come from
+    settleFraction = 0.5 #and the most of the step they come from, so short steps still have a transient before it
+    settleTaus = 3 #time constants before the tail starts for the time constant to count (the tail's within 5% then)
+
+    def __init__(self, setpoints, sensedColumn=1, sourceColumn=None):
+        self.setpoints = np.asarray(setpoints, dtype=float)
+        self.sensedColumn = sensedColumn #1 for current when sourcing voltage, 0 for voltage when sourcing current
+        self.sourceColumn = 1 - sensedColumn if sourceColumn is None else sourceColumn
+        self.order = np.argsort(self.setpoints)
+        self.sortedPoints = self.setpoints[self.order]
+        self.rows = []
+        self.step = None #index into setpoints of the step going on now
+        self.tFirst = None
+
+    #which setpoint each source reading is closest to
+    def _nearest(self, source):
+        j = np.clip(np.searchsorted(self.sortedPoints, source), 1, max(len(self.sortedPoints) - 1, 1))
+        below = self.sortedPoints[j - 1]
+        above = self.sortedPoints[np.minimum(j, len(self.sortedPoints) - 1)]
+        return self.order[np.where(np.abs(source - below) <= np.abs(above - source), j - 1, j)]
+
+    def _startStep(self, step, t, y):
+        self.step = step
+        self.tStart = t
+        self.tLast = t
+        self.yLast = y
+        self.y0 = y
+        self.n = 0
+        self.yMin = np.inf
+        self.yMax = -np.inf
+        self.integral = 0.0 #of the sensed value over time
+        self.tailT = np.empty(0) #readings in the last settleWindow seconds
+        self.tailY = np.empty(0)
+
+    #take in the readings of one step from one block (t and y are the times and sensed values)
+    def _accumulate(self, t, y):
+        tPrev = np.concatenate(([self.tLast], t[:-1]))
+        yPrev = np.concatenate(([self.yLast], y[:-1]))
+        self.integral = self.integral + np.sum((t - tPrev)*(y + yPrev)/2)
+        tailT = np.concatenate((self.tailT, t))
+        keep = tailT >= t[-1] - self.settleWindow
+        self.tailT, self.tailY = tailT[keep], np.concatenate((self.tailY, y))[keep]
+        self.yMin = min(self.yMin, np.min(y))
+        self.yMax = max(self.yMax, np.max(y))
+        self.n = self.n + len(t)
+        self.tLast = t[-1]
+        self.yLast = y[-1]
+
+    def _finishStep(self):
+        duration = self.tLast - self.tStart
+        tailWindow = min(self.settleWindow, self.settleFraction*duration)
+        tail = self.tailY[self.tailT >= self.tLast - tailWindow]
+        settled = np.mean(tail)
+        noise = np.std(tail)
+        offset = self.y0 - settled
+        tau = (self.integral - settled*duration)/offset if offset != 0 else np.nan
+        if len(tail) < 2 or not 0 < tau <= (duration - tailWindow)/self.settleTaus:
+            tau = np.nan
+        if offset > 0: #coming down to the settled value, overshoot is below it
+            overshoot = max(settled - self.yMin, 0)
+        else:
+            overshoot = max(self.yMax - settled, 0)
+        self.rows.append((self.setpoints[self.step], self.tStart - self.tFirst, duration, self.n, self.y0, settled, tau,
+                          overshoot, noise))
+        self.step = None
+
+    #take in another (n, >=3) block of voltage, current, time... rows
+    def update(self, data):
+        if len(data) == 0 or len(self.setpoints) == 0:
+            return
+        t = np.asarray(data[:,2], dtype=float)
+        y = np.asarray(data[:,self.sensedColumn], dtype=float)
+        steps = self._nearest(np.asarray(data[:,self.sourceColumn], dtype=float))
+        if self.tFirst is None:
+            self.tFirst = t[0]
+        changes = np.flatnonzero(steps[1:] != steps[:-1]) + 1
+        for start, end in zip(np.concatenate(([0], changes)), np.concatenate((changes, [len(t)]))):
+            if self.step is not None and steps[start] != self.step:
+                self._finishStep()
+            if self.step is None:
+                self._startStep(steps[start], t[start], y[start])
+            self._accumulate(t[start:end], y[start:end])
+
+    #voltages and currents of the settled I-V curve, one point per step
+    def curve(self):
+        table = self.table()
+        if self.sensedColumn == 1: #sourcing voltage
+            return table[:,0], table[:,5]
+        return table[:,5], table[:,0]
+
+    #a row of transientColumns for every step, including the one that's still going
+    def table(self):
+        if self.step is not None:
+            self._finishStep()
+        return np.array(self.rows).reshape((-1, len(transientColumns)))
+
+    #save the table next to the data
+    def save(self, path, sensedName='Current [A]'):
+        hdr = 'Per step transient summary, times are in seconds from the first reading, sensed values are {0:s}\n'.format(sensedName)
+        np.savetxt(path, self.table(), delimiter=',', header=hdr + ','.join(transientColumns))
+
+fomKeys = ['Voc [V]', 'Isc [A]', 'Pmax [W]', 'Vmpp [V]', 'Impp [A]', 'FF', 'Rs [ohm]', 'Rsh [ohm]', 'PCE [%]']
+
+#stack (v, i) curves of different lengths into nan padded (nCurves, longest) arrays for figuresOfMerit
+def padCurves(curves):
+    length = max([len(v) for v, i in curves] + [0])
+    v = np.full((len(curves), length), np.nan)
+    i = np.full((len(curves), length), np.nan)
+    for n, (vn, iN) in enumerate(curves):
+        v[n,:len(vn)] = vn
+        i[n,:len(iN)] = iN
+    return v, i
+
+#x where y crosses zero along each row (rows sorted by x), the index of the point before the crossing and if it was found
+def _crossing(x, y):
+    rows = np.arange(len(x))
+    y0, y1 = y[:,:-1], y[:,1:]
+    with np.errstate(invalid='ignore'):
+        mask = (y0*y1 <= 0) & (y0 != y1) #nan compares false, padding never counts
+    k = np.argmax(mask, axis=1)
+    found = np.any(mask, axis=1)
+    xa, xb, ya, yb = x[rows,k], x[rows,k+1], y[rows,k], y[rows,k+1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        crossing = xa - ya*(xb - xa)/(yb - ya)
+    return np.where(found, crossing, np.nan), k, found
+
+#dy/dx of a straight line fit to the nPoints around points k and k+1 of each row
+def _localSlope(x, y, k, nPoints):
+    rows = np.arange(len(x))[:,None]
+    cols = np.clip(k[:,None] + np.arange(nPoints) - (nPoints//2 - 1), 0, x.shape[1] - 1)
+    xs, ys = x[rows,cols], y[rows,cols]
+    valid = np.isfinite(xs) & np.isfinite(ys)
+    count = np.maximum(np.sum(valid, axis=1), 1)
+    dx = np.where(valid, xs - (np.sum(np.where(valid, xs, 0), axis=1)/count)[:,None], 0)
+    dy = np.where(valid, ys - (np.sum(np.where(valid, ys, 0), axis=1)/count)[:,None], 0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sum(dx*dy, axis=1)/np.sum(dx*dx, axis=1)
+
+#figures of merit for one curve (1D v and i, gives floats) or a batch of them (2D, gives arrays), area in cm^2
+def figuresOfMerit(v, i, area, fitPoints=5):
+    single = np.ndim(v) == 1
+    v = np.atleast_2d(np.asarray(v, dtype=float))
+    i = np.atleast_2d(np.asarray(i, dtype=float))
+    nan = np.full(len(v), np.nan)
+    if v.shape[1] < 2:
+        values = [nan]*len(fomKeys)
+    else:
+        order = np.argsort(v, axis=1) #nan padding sorts to the end
+        rows = np.arange(len(v))[:,None]
+        v, i = v[rows,order], i[rows,order]
+        rows = np.arange(len(v))
+        voc, kVoc, foundVoc = _crossing(v, i)
+        iAt0, kIsc, foundIsc = _crossing(i, v)
+        isc = -iAt0
+        power = np.where(np.isfinite(v*i), v*i, np.inf)
+        kMpp = np.argmin(power, axis=1)
+        pMax = -power[rows,kMpp]
+        pMax[np.isinf(pMax)] = np.nan #rows with no data
+        vMpp = v[rows,kMpp]
+        iMpp = -i[rows,kMpp]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            ff = pMax/(voc*isc)
+            rs = np.where(foundVoc, 1/_localSlope(v, i, kVoc, fitPoints), np.nan)
+            rsh = np.where(foundIsc, 1/_localSlope(v, i, kIsc, fitPoints), np.nan)
+            pce = pMax*1000/np.asarray(area, dtype=float) #W -> mW over 100 mW/cm^2, in %
+            #a curve that isn't a clean diode curve (unsettled steps, noise) can give numbers no cell could have
+            ff = np.where((ff >= 0) & (ff <= 1), ff, np.nan)
+            rs = np.where(rs >= 0, rs, np.nan)
+            rsh = np.where(rsh >= 0, rsh, np.nan)
+        values = [voc, isc, pMax, vMpp, iMpp, ff, rs, rsh, pce]
+    if single:
+        return OrderedDict((key, float(value[0])) for key, value in zip(fomKeys, values))
+    return OrderedDict(zip(fomKeys, values))
+
+def saveFiguresOfMerit(path, fom):
+    writeJson(path, OrderedDict((key, value if np.isfinite(value) else None) for key, value in fom.items()))
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+here we have the live data view, voltage and current vs time as the readings come in
+
+minMaxDecimator keeps the min and max voltage and current in each of a fixed number of time bins. when the data
+runs past the last bin neighbouring bins get merged, so the bins cover twice as much time each and there's room for
+as much again. memory stays the same however long it runs and the plot still shows every spike, each bin is drawn as
+a vertical line from its min to its max. append is a few numpy operations per block, cheap enough for
+readRealTimeDataThread to do as it saves:
+decimator = minMaxDecimator()
+decimator.append(block) #rows of voltage, current, time, status (as the instrument sends them)
+t, lo, hi = decimator.snapshot() #bin centers, min and max of [voltage, current] in each
+
+livePlotWindow draws a decimator from a QTimer in the gui thread, at most every redrawInterval ms and only when
+there's new data, so the reader never waits on matplotlib
+"""
+import threading
+import numpy as np
+from PyQt4.QtCore import QTimer, pyqtSignal
+from PyQt4.QtGui import QWidget, QVBoxLayout
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg
+
+class minMaxDecimator:
+    def __init__(self, nBins=2000, binWidth=0.005):
+        self.nBins = nBins - nBins % 2 #merging goes pairwise
+        self.initialWidth = binWidth #seconds, about one reading per bin at the start
+        self.lock = threading.Lock() #appended to from the reader thread, drawn from the gui thread
+        self.version = 0 #goes up with every change, so the plot can tell when it's behind
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.lo = np.full((self.nBins, 2), np.inf)
+            self.hi = np.full((self.nBins, 2), -np.inf)
+            self.width = self.initialWidth
+            self.t0 = None
+            self.lastTime = None
+            self.offset = 0.0 #added to the instrument's time stamps so they keep going up when its clock gets reset
+            self.version = self.version + 1
+
+    #merge neighbouring bins so they cover twice the time each
+    def _compact(self):
+        half = self.nBins//2
+        self.lo[:half] = self.lo.reshape((half, 2, 2)).min(axis=1)
+        self.hi[:half] = self.hi.reshape((half, 2, 2)).max(axis=1)
+        self.lo[half:] = np.inf
+        self.hi[half:] = -np.inf
+        self.width = self.width*2
+
+    def append(self, block):
+        if len(block) == 0:
+            return
+        values = np.asarray(block[:,0:2], dtype=float)
+        t = np.asarray(block[:,2], dtype=float)
+        with self.lock:
+            if self.t0 is None:
+                self.t0 = t[0]
+            elif t[0] < self.lastTime: #the instrument's clock went back to zero, carry on from where it was
+                self.offset = self.offset + self.lastTime - t[0]
+            self.lastTime = t[-1]
+            bins = np.maximum(((t + self.offset - self.t0)/self.width).astype(np.int64), 0)
+            while bins[-1] >= self.nBins:
+                self._compact()
+                bins = bins//2
+            #readings come in time order so each bin's readings are next to each other
+            starts = np.flatnonzero(np.concatenate(([True], bins[1:] != bins[:-1])))
+            used = bins[starts]
+            self.lo[used] = np.minimum(self.lo[used], np.minimum.reduceat(values, starts, axis=0))
+            self.hi[used] = np.maximum(self.hi[used], np.maximum.reduceat(values, starts, axis=0))
+            self.version = self.version + 1
+
+    #copies of the bins that have data: times (bin centers, seconds from the first reading), min and max
+    def snapshot(self):
+        with self.lock:
+            used = np.flatnonzero(np.isfinite(self.lo[:,0]))
+            return (used + 0.5)*self.width, self.lo[used], self.hi[used]
+
+class livePlotWindow(QWidget):
+    redrawInterval = 250 #ms
+    closed = pyqtSignal()
+
+    def __init__(self, decimator, parent=None):
+        QWidget.__init__(self, parent)
+        self.setWindowTitle('Live Data View')
+        self.decimator = decimator
+        self.drawnVersion = None
+
+        self.figure = Figure()
+        self.canvas = FigureCanvasQTAgg(self.figure)
+        layout = QVBoxLayout(self)
+        layout.addWidget(self.canvas)
+        self.vAxes = self.figure.add_subplot(211)
+        self.iAxes = self.figure.add_subplot(212, sharex=self.vAxes)
+        self.vAxes.set_ylabel('Voltage [V]')
+        self.iAxes.set_ylabel('Current [A]')
+        self.iAxes.set_xlabel('Time [s]')
+        self.vLine, = self.vAxes.plot([], [], linewidth=1)
+        self.iLine, = self.iAxes.plot([], [], linewidth=1)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.redraw)
+        self.timer.start(self.redrawInterval)
+
+    def redraw(self):
+        if self.decimator.version == self.drawnVersion or not self.isVisible():
+            return
+        self.drawnVersion = self.decimator.version
+        t, lo, hi = self.decimator.snapshot()
+        t = np.repeat(t, 2) #a vertical line from min to max in each bin
+        self.vLine.set_data(t, np.column_stack((lo[:,0], hi[:,0])).ravel())
+        self.iLine.set_data(t, np.column_stack((lo[:,1], hi[:,1])).ravel())
+        for axes in (self.vAxes, self.iAxes):
+            axes.relim()
+            axes.autoscale_view()
+        self.canvas.draw_idle()
+
+    def closeEvent(self, event):
+        self.closed.emit()
+        QWidget.closeEvent(self, event)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+here we have the maximum power point tracker
+
+mpptTracker doesn't know anything about the gui or the instrument. it gets a function that sources a value and
+returns the (voltage, current, time, status) reading the instrument takes there, so it can run anywhere
+(maxPowerThread runs it in the background for the gui):
+tracker = mpptTracker(measure, '0.12', 0.7, algorithm='perturbObserve', stepSize=0.005)
+for cycle in range(nCycles):
+    setpoint = tracker.update() #find the max power point again
+    row = tracker.reading() #time, setpoint, voltage, current, power and efficiency at it
+tracker.stop() makes an update in progress raise trackingStopped at its next measurement
+
+algorithms:
+'cobyla' runs a full scipy COBYLA minimization every update, that's dozens of measurements each time
+the rest start with one of those to find the max power point and then just follow it, one measurement per update:
+'perturbObserve' tries a step (stepSize) away from the setpoint and moves there if there's more power, otherwise it
+    tries the other direction next time
+'incrementalConductance' measures a step away and steps towards where dP/dV = I + V*dI/dV = 0, staying put once
+    that's within tolerance
+'parabola' dithers the setpoint by a step either side and moves to the peak of a parabola fit to power vs setpoint
+    over the last fitPoints readings (at most maxSteps steps at a time), falling back to perturb and observe when the
+    fit doesn't have a peak
+
+COBYLA probes a lot of points it has already been to (and the instrument only gets setpoints to 4 decimal places
+anyway), so during those minimizations measurements go through a measurementCache: a reading at the same setpoint
+(to cacheResolution) less than cacheAge seconds old gets reused instead of measuring again. tracker.cache.hits and
+.misses say how much that saved. dwell readings and the local algorithms always measure
+
+power is voltage*current with the sourcemeter's sign convention, so a cell putting out power reads negative and the
+max power point is where that's most negative. efficiency assumes 1 sun (100 mW/cm^2) of illumination
+"""
+import numpy as np
+from collections import deque
+from scipy import optimize
+from timing import monotonic
+
+trackerColumns = ['Time [s]', 'Setpoint', 'Voltage [V]', 'Current [A]', 'Power [W]', 'Efficiency [%]']
+
+class trackingStopped(Exception):
+    pass
+
+#remembers recent readings by quantized setpoint so they can be reused for a little while
+class measurementCache:
+    def __init__(self, measure, resolution=1e-4, maxAge=0.5):
+        self.measure = measure
+        self.resolution = resolution
+        self.maxAge = maxAge #seconds
+        self.readings = {} #quantized setpoint: (when, reading)
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, setpoint):
+        now = monotonic()
+        key = int(round(setpoint/self.resolution))
+        if key in self.readings and now - self.readings[key][0] <= self.maxAge:
+            self.hits = self.hits + 1
+            return self.readings[key][1]
+        self.misses = self.misses + 1
+        reading = self.measure(setpoint)
+        self.readings = dict((k, r) for k, r in self.readings.items() if now - r[0] <= self.maxAge) #forget stale ones
+        self.readings[key] = (monotonic(), reading)
+        return reading
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hitRate': float(self.hits)/total if total > 0 else None}
+
+class mpptTracker:
+    algorithms = ['cobyla', 'perturbObserve', 'incrementalConductance', 'parabola']
+    fitPoints = 20 #readings the parabola gets fit to
+    maxSteps = 4 #furthest the parabola fit can move the setpoint in one update, in steps
+    tolerance = 1e-4 #incremental conductance is happy when |dP/dV| is below this (W/V)
+    cacheResolution = 1e-4 #setpoints closer than this count as the same during COBYLA minimizations
+    cacheAge = 0.5 #seconds a reading can be reused for during COBYLA minimizations, 0 to always measure
+
+    def __init__(self, measure, area, initialGuess, algorithm='perturbObserve', stepSize=0.005):
+        if algorithm not in self.algorithms:
+            raise ValueError('Unknown tracking algorithm: {0:s}'.format(algorithm))
+        self.measure = measure #measure(setpoint) -> (voltage, current, time, status)
+        self.area = float(area) #cm^2
+        self.setpoint = initialGuess
+        self.algorithm = algorithm
+        self.continuous = algorithm != 'cobyla' #cheap enough to update before every reading
+        self.stepSize = stepSize
+        self.direction = 1
+        self.located = False #the local algorithms need one full optimization to know where to start
+        self.history = deque(maxlen=self.fitPoints) #(setpoint, voltage, current) of recent measurements
+        self.stopNow = False
+        self.nMeasurements = 0
+        self.nUpdates = 0
+        self.cache = measurementCache(self._measure, self.cacheResolution, self.cacheAge)
+
+    def stop(self):
+        self.stopNow = True
+
+    def _measure(self, setpoint):
+        if self.stopNow:
+            raise trackingStopped()
+        self.nMeasurements = self.nMeasurements + 1
+        v, i, t, status = self.measure(setpoint)
+        self.history.append((setpoint, v, i))
+        return v, i, t, status
+
+    #the last reading taken at the setpoint, measuring one if the last one was somewhere else
+    def _here(self):
+        if len(self.history) == 0 or self.history[-1][0] != self.setpoint:
+            self._measure(self.setpoint)
+        return self.history[-1]
+
+    #what the optimizer minimizes
+    def _power(self, x):
+        if self.stopNow: #even if every point it wants is cached
+            raise trackingStopped()
+        v, i, t, status = self.cache(float(x[0]))
+        return v*i
+
+    #relocate the max power point starting from where it was last time, returns the new setpoint
+    def update(self):
+        self.nUpdates = self.nUpdates + 1
+        if self.algorithm == 'cobyla' or not self.located:
+            self._optimize()
+            self.located = True
+        elif self.algorithm == 'perturbObserve':
+            self._perturbObserve()
+        elif self.algorithm == 'incrementalConductance':
+            self._incrementalConductance()
+        else:
+            self._parabola()
+        return self.setpoint
+
+    def _optimize(self):
+        optResults = optimize.minimize(self._power,self.setpoint,method='COBYLA',tol=1e-4,options={'rhobeg':0.2})
+        self.setpoint = float(optResults.x)
+
+    def _perturbObserve(self):
+        s, v, i = self._here()
+        trial = s + self.direction*self.stepSize
+        vT, iT, t, status = self._measure(trial)
+        if vT*iT < v*i: #more power out there
+            self.setpoint = trial
+        else:
+            self.direction = -self.direction
+
+    def _incrementalConductance(self):
+        s, v, i = self._here()
+        trial = s + self.direction*self.stepSize
+        vT, iT, t, status = self._measure(trial)
+        self.direction = -self.direction #alternate the side we look at so we don't creep
+        if vT == v:
+            return
+        dIdV = (iT - i)/(vT - v)
+        dPdV = (i + iT)/2 + (v + vT)/2*dIdV
+        if abs(dPdV) > self.tolerance: #power is most negative where dP/dV = 0
+            self.setpoint = s - np.sign(dPdV)*self.stepSize
+
+    def _parabola(self):
+        trial = self.setpoint + self.direction*self.stepSize
+        self._measure(trial)
+        self.direction = -self.direction
+        h = np.array(self.history)
+        if len(np.unique(h[:,0])) >= 3:
+            a, b, c = np.polyfit(h[:,0], h[:,1]*h[:,2], 2)
+            if a > 0: #power has a minimum (the max power point)
+                step = np.clip(-b/(2*a) - self.setpoint, -self.maxSteps*self.stepSize, self.maxSteps*self.stepSize)
+                self.setpoint = self.setpoint + float(step)
+                return
+        s, v, i = self._here() #no usable fit yet, go the way power goes up
+        if h[-1,1]*h[-1,2] < v*i:
+            self.setpoint = trial
+
+    def efficiency(self, power):
+        return -power*1000/self.area #W -> mW over 100 mW/cm^2, in %
+
+    #one reading at the current setpoint as a row of trackerColumns
+    def reading(self):
+        v, i, t, status = self._measure(self.setpoint)
+        return np.array([t, self.setpoint, v, i, v*i, self.efficiency(v*i)])
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+here we have running the same recipe (see acquisition.py) on several sourcemeters at once
+
+each instrument gets its own gpib worker process and its own acquisition running in its own thread, so sweeps on
+different instruments overlap and all they share is the bus. channel n's files are named
+<name>_ch<n>_<unix time>.<format> (or it gets its own session file) and <name>_<unix time>_channels.json ties the
+run together: the address each channel was, what it said it was, and the file and summary of every sweep it did
+m = multiInstrument(['GPIB0::24', 'GPIB0::25']) #or multiInstrument(findSourcemeters())
+manifest = m.run(recipe)
+m.close()
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+from gpib import gpib, gpibError
+from acquisition import acquisition
+from dataWriters import writeJson, jsonParameters
+
+#addresses of the keithley 2400s on the bus
+def findSourcemeters(model='MODEL 2400'):
+    found = []
+    for address in gpib().findInstruments():
+        try:
+            k = gpib(address, timeout=5)
+            if model in k.ask('*idn?'):
+                found.append(address)
+            k.__del__()
+        except Exception:
+            pass #not something that answers *idn?
+    return found
+
+class multiInstrument:
+    def __init__(self, addresses, log=None, useRing=False):
+        self.log = log if log is not None else lambda message: None
+        self.addresses = list(addresses)
+        self.instruments = [gpib(address, useQueues=True, timeout=None, useRing=useRing) for address in self.addresses]
+        self.stations = []
+        self.idns = []
+        for n, k in enumerate(self.instruments):
+            self.stations.append(acquisition(k, self._channelLog(n)))
+            try:
+                self.idns.append(k.ask('*idn?', 10))
+            except gpibError:
+                self.idns.append(None)
+
+    def _channelLog(self, n):
+        return lambda message: self.log('ch{0:d}: {1:s}'.format(n, message))
+
+    def _runChannel(self, n, recipe, results):
+        try:
+            self.stations[n].setup(recipe)
+            results[n] = {'sweeps': self.stations[n].runRecipe(recipe)}
+        except Exception as e: #one channel failing shouldn't take the others down
+            self._channelLog(n)('failed: {0:s}'.format(repr(e)))
+            results[n] = {'error': repr(e)}
+
+    #run recipe on every instrument at the same time, returns the manifest that's saved next to the data
+    def run(self, recipe):
+        startTime = time.time()
+        results = {}
+        threads = []
+        for n in range(len(self.instruments)):
+            channelRecipe = dict(recipe, name='{0:s}_ch{1:d}'.format(recipe['name'], n))
+            thread = threading.Thread(target=self._runChannel, args=(n, channelRecipe, results))
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            while thread.is_alive(): #with a timeout so ctrl-c still gets through
+                thread.join(0.5)
+
+        manifest = OrderedDict()
+        manifest['startTime'] = startTime
+        manifest['endTime'] = time.time()
+        manifest['recipe'] = recipe
+        manifest['channels'] = []
+        for n, address in enumerate(self.addresses):
+            channel = OrderedDict([('channel', n), ('address', address), ('idn', self.idns[n])])
+            result = results.get(n, {})
+            if 'error' in result:
+                channel['error'] = result['error']
+            channel['sweeps'] = [OrderedDict([('file', path), ('parameters', jsonParameters(parameters))])
+                                 for path, parameters in result.get('sweeps', [])]
+            manifest['channels'].append(channel)
+        writeJson(os.path.join(recipe['outputDir'], '{0:s}_{1:d}_channels.json'.format(recipe['name'], int(startTime))), manifest)
+        return manifest
+
+    #finish the sweeps that are running early and don't start any more
+    def stop(self):
+        for station in self.stations:
+            station.stop()
+
+    def close(self):
+        for k in self.instruments:
+            k.__del__()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+here we have a shared memory ring buffer for moving readings from the gpib worker process to the gui process
+
+the queue transport pickles every reading, pushes it down a pipe and unpickles it on the other side (with a feeder
+thread at each end), this instead has the worker process write decoded float32 records straight into shared memory
+and the reader looks at them in place through numpy views
+
+it's for exactly one producer process and one consumer process: head (records written) is only ever advanced by
+the producer and tail (records read) only by the consumer, each after the data it guards has been written/used
+multiprocessing.shared_memory isn't around in python 2 so the storage is a multiprocessing RawArray
+
+producer (gpib worker):
+ring.write(records) #blocks while the ring is full, or with fullPolicy='drop' throws away what doesn't fit
+consumer:
+blocks = ring.blocksWritten()
+for view in ring.consume(timeout=1): #views into shared memory, copy out what you need
+    keep.append(view)
+ring.release()
+"""
+import ctypes
+import numpy as np
+from multiprocessing import Event
+from multiprocessing.sharedctypes import RawArray, RawValue
+
+class ringBuffer:
+    def __init__(self, nColumns=4, capacity=65536, fullPolicy='block'):
+        self.nColumns = nColumns
+        self.capacity = capacity #in records
+        self.fullPolicy = fullPolicy #'block' waits for the consumer to make room, 'drop' loses the records that don't fit
+        self.storage = RawArray(ctypes.c_float, capacity*nColumns)
+        self.head = RawValue(ctypes.c_ulonglong, 0) #total records ever written
+        self.tail = RawValue(ctypes.c_ulonglong, 0) #total records ever released by the consumer
+        self.blocks = RawValue(ctypes.c_ulonglong, 0) #total write calls, one per instrument transaction
+        self.stalls = RawValue(ctypes.c_ulonglong, 0) #writes that had to wait for room
+        self.dropped = RawValue(ctypes.c_ulonglong, 0) #records thrown away because there wasn't room
+        self.dataReady = Event() #set by the producer after a write
+        self.spaceFree = Event() #set by the consumer after a release
+        self.pending = 0 #records handed out by the last consume that haven't been released yet
+
+    #numpy view of the shared storage, cheap enough to make every time and this way it's never pickled
+    def _view(self):
+        return np.frombuffer(self.storage, dtype=np.float32).reshape((self.capacity, self.nColumns))
+
+    def available(self):
+        return int(self.head.value - self.tail.value)
+
+    def blocksWritten(self):
+        return int(self.blocks.value)
+
+    #producer side: copy records ((n, nColumns) array) into the ring, waiting for the consumer if there's no room
+    def write(self, records):
+        view = self._view()
+        records = np.asarray(records).reshape((-1, self.nColumns))
+        waited = False
+        while len(records) > 0:
+            self.spaceFree.clear()
+            free = self.capacity - self.available()
+            if free == 0 and self.fullPolicy == 'drop':
+                self.dropped.value = self.dropped.value + len(records)
+                break
+            if free == 0:
+                if not waited:
+                    self.stalls.value = self.stalls.value + 1
+                    waited = True
+                self.spaceFree.wait(0.1)
+                continue
+            chunk = records[:free]
+            start = int(self.head.value % self.capacity)
+            firstPart = min(len(chunk), self.capacity - start)
+            view[start:start+firstPart] = chunk[:firstPart]
+            view[:len(chunk)-firstPart] = chunk[firstPart:]
+            self.head.value = self.head.value + len(chunk) #publish only once the data is in place
+            records = records[len(chunk):]
+            self.dataReady.set()
+        self.blocks.value = self.blocks.value + 1
+        self.dataReady.set()
+
+    #consumer side: wait up to timeout seconds for data and return views of all the unread records
+    #(two views when the data wraps around the end of the storage), call release() once done with them
+    def consume(self, timeout=None):
+        self.dataReady.clear()
+        if self.available() == 0:
+            self.dataReady.wait(timeout)
+        nRecords = self.available()
+        start = int(self.tail.value % self.capacity)
+        view = self._view()
+        firstPart = min(nRecords, self.capacity - start)
+        self.pending = nRecords
+        views = [view[start:start+firstPart]]
+        if nRecords > firstPart:
+            views.append(view[:nRecords-firstPart])
+        return views
+
+    #hand the space used by the records from the last consume back to the producer
+    def release(self):
+        self.tail.value = self.tail.value + self.pending
+        self.pending = 0
+        self.spaceFree.set()
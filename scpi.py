@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+here we have helpers for working with the SCPI commands we send the sourcemeter
+
+shortHeader puts a command header into one canonical form, the SCPI short form, so ':source:voltage:start 1' and
+':SOUR:VOLT:STAR 0.5' can be recognized as setting the same thing
+
+coalesce joins a run of queued writes into as few messages as possible (';' separated, each under maxLength
+characters). a write is dropped when a later one in the same run sets the same thing, unless something that could
+depend on the earlier value (see isBarrier) happens in between. source levels are never dropped, every step of a
+sweep has to reach the instrument
+
+shadowState remembers the last value written for each setting, so a write that wouldn't change anything can be
+skipped. things that reset the instrument forget everything, as does writing something we can't make sense of.
+source levels, actions and settings the instrument changes by itself (like trace feed control) are never remembered:
+shadow = shadowState()
+shadow.record(':sense:current:nplcycles 0.01') #every write that goes out
+shadow.isCurrent(':SENS:CURR:NPLC 0.010') #True, no need to send it
+"""
+import threading
+
+#short form of one node, e.g. 'voltage' -> 'volt', 'delay' -> 'del' (the first four letters, less the 4th if it's a
+#vowel), nodes of four letters or less like 'data' or 'list' are their own short form
+def _shortNode(node):
+    letters = node.rstrip('0123456789')
+    suffix = node[len(letters):]
+    if len(letters) > 4 and not letters.startswith('*'):
+        letters = letters[:3] if letters[3] in 'aeiou' else letters[:4]
+    return letters + suffix
+
+#canonical header of a single command, e.g. ':SOURce:VOLTage:STARt 1' -> 'sour:volt:star'
+def shortHeader(command):
+    parts = command.strip().split(None, 1)
+    if not parts:
+        return ''
+    header = parts[0].lstrip(':').lower()
+    query = header.endswith('?')
+    nodes = [_shortNode(node) for node in header.rstrip('?').split(':')]
+    return ':'.join(nodes) + ('?' if query else '')
+
+#commands that act on the instrument, anything set before one of these could matter
+barrierHeaders = set(shortHeader(command) for command in [
+    ':output', ':output:state', ':initiate', ':abort', ':read?', ':measure?', ':fetch?', ':source:function',
+    ':source:function:mode', ':sense:function', ':sense:function:concurrent', ':trace:clear', ':trace:feed:control',
+    ':system:key', ':system:preset', ':system:azero', ':system:azero:state', ':source2:ttl'])
+#settings where every value has to get there, not just the last one
+neverDropped = set(shortHeader(command) for command in [
+    ':source:voltage', ':source:current', ':source:voltage:level', ':source:current:level',
+    ':source:voltage:level:immediate:amplitude', ':source:current:level:immediate:amplitude',
+    ':source:list:voltage:append', ':source:list:current:append', ':display:window:text:data',
+    ':display:window2:text:data'])
+
+#the argument of a single command, '' if it doesn't have one
+def argument(command):
+    parts = command.strip().split(None, 1)
+    return parts[1].strip() if len(parts) > 1 else ''
+
+#true for writes that nothing can be dropped across: several commands in one, queries, common commands and actions
+def isBarrier(command):
+    if ';' in command or '?' in command:
+        return True
+    header = shortHeader(command)
+    return header.startswith('*') or header in barrierHeaders
+
+def _droppable(command):
+    return not isBarrier(command) and shortHeader(command) not in neverDropped
+
+#commands with the ones that get overwritten before anything could notice removed
+def dropSuperseded(commands):
+    kept = []
+    later = set() #headers set again later with no barrier in between
+    for command in reversed(commands):
+        if isBarrier(command):
+            later = set()
+        elif _droppable(command):
+            header = shortHeader(command)
+            if header in later:
+                continue
+            later.add(header)
+        kept.append(command)
+    kept.reverse()
+    return kept
+
+#join writes into ';' separated messages of at most maxLength characters (longer single writes go on their own)
+def coalesce(commands, maxLength=256):
+    messages = []
+    current = ''
+    for command in dropSuperseded(commands):
+        command = command.strip()
+        if not command:
+            continue
+        if not command.startswith(':') and not command.startswith('*'): #so it doesn't get read relative to the command before it
+            command = ':' + command
+        if current and len(current) + 1 + len(command) > maxLength:
+            messages.append(current)
+            current = ''
+        current = current + ';' + command if current else command
+    if current:
+        messages.append(current)
+    return messages
+
+#commands that reset settings we might remember
+resetHeaders = set(shortHeader(command) for command in ['*rst', '*rcl', ':system:preset'])
+#settings we don't remember
+unshadowed = neverDropped | set(shortHeader(command) for command in [
+    ':output', ':output:state', ':initiate', ':abort', ':trace:clear', ':trace:feed:control', ':system:key',
+    ':system:azero', ':system:azero:state', ':source:list:voltage', ':source:list:current'])
+
+#argument in one canonical form, so '0.100' and '0.1' or '"CURR:DC", "VOLT:DC"' and '"curr:dc","volt:dc"' match
+def _canonicalArgument(command):
+    arg = argument(command).lower().replace(' ', '').replace('"', '').replace("'", '')
+    try:
+        return repr(float(arg))
+    except ValueError:
+        return arg
+
+class shadowState:
+    def __init__(self):
+        self.values = {} #short header: canonical argument
+        self.lock = threading.Lock() #writes get recorded from several threads
+
+    def invalidate(self):
+        with self.lock:
+            self.values = {}
+
+    #the single commands in a message as (header, canonical argument) if we can remember them, None otherwise
+    def _settings(self, message):
+        settings = []
+        for i, command in enumerate(message.split(';')):
+            command = command.strip()
+            if i > 0 and not command.startswith(':') and not command.startswith('*'):
+                return None #relative to the command before it, we don't keep track of that
+            header = shortHeader(command)
+            if not header or header.endswith('?') or header.startswith('*') or header in unshadowed:
+                return None
+            settings.append((header, _canonicalArgument(command)))
+        return settings
+
+    #true when sending message wouldn't change anything
+    def isCurrent(self, message):
+        settings = self._settings(message)
+        if not settings:
+            return False
+        with self.lock:
+            return all(self.values.get(header) == value for header, value in settings)
+
+    #note what a message that's going out sets
+    def record(self, message):
+        with self.lock:
+            for i, command in enumerate(message.split(';')):
+                command = command.strip()
+                if not command:
+                    continue
+                if i > 0 and not command.startswith(':') and not command.startswith('*'):
+                    self.values = {} #relative header, no idea what it changed
+                    continue
+                header = shortHeader(command)
+                if header in resetHeaders:
+                    self.values = {}
+                    continue
+                #a setting can change the ones around it in the tree (e.g. a range turns off its autorange)
+                for other in list(self.values.keys()):
+                    if other.startswith(header + ':') or header.startswith(other + ':'):
+                        del self.values[other]
+                if header.endswith('?') or header.startswith('*') or header in unshadowed:
+                    self.values.pop(header, None)
+                else:
+                    self.values[header] = _canonicalArgument(command)
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+here we have the session files continual sweep mode can save into instead of making a new file for every sweep
+
+a session is two files:
+<name>_<unix time>.session holds the sweeps one after the other, each one is a record made of
+    a recordHeader: 'SWP1', sweep index, start time, number of columns, length of the settings json, number of rows
+    the settings json (the usual header fields plus whatever sweep settings were passed in)
+    the rows, little endian float32
+<name>_<unix time>.session.idx has one fixed size entry (indexDtype) per finished sweep: sweep index, start time,
+    sweepUp and where its record starts, so sweep n's entry is the nth one and finding the sweep that was running
+    at some time is a binary search over the start times
+
+writing (a sweep has the same append/close interface as the writers in dataWriters.py):
+session = sessionWriter('/data/cell1')
+sweep = session.newSweep(sweepFields('0.12', True, True), {'dt': 0.02})
+sweep.append(block)
+sweep.close()
+session.close()
+
+reading:
+s = sessionReader('/data/cell1_1400000000.session')
+fields, data = s.sweep(3) #data is a memory map of the (n, nColumns) float32 rows
+fields, data = s.sweepAt(1400000123.4) #the sweep that was running at that unix time
+
+the row count in each record header is kept current as data comes in, so if we crash mid sweep
+rebuildIndex('/data/cell1_1400000000.session') recovers every sweep in the file, including the partial one
+"""
+import os
+import time
+import json
+import struct
+import numpy as np
+from collections import OrderedDict
+
+recordHeader = struct.Struct('<4sIdIIQ')
+rowsOffset = recordHeader.size - 8 #where the row count sits in the record header
+indexDtype = np.dtype([('index', '<u4'), ('startTime', '<f8'), ('sweepUp', 'u1'), ('offset', '<u8')])
+magic = b'SWP1'
+
+class sessionWriter:
+    def __init__(self, savePath):
+        self.path = savePath+'_'+str(int(time.time()))+'.session'
+        self.stem = os.path.splitext(self.path)[0]
+        self.nSweeps = 0
+        self.current = None
+        self.f = open(self.path, 'w+b')
+        self.idx = open(self.path + '.idx', 'wb')
+
+    #start a new sweep record, fields are the header fields (see dataWriters.sweepFields), settings anything else worth keeping
+    def newSweep(self, fields, settings={}, nColumns=4):
+        if self.current is not None: #whatever was left open is as finished as it's going to get
+            self.current.close()
+        meta = OrderedDict(fields)
+        meta['settings'] = settings
+        self.current = sessionSweep(self, self.nSweeps, meta, nColumns)
+        self.nSweeps = self.nSweeps + 1
+        return self.current
+
+    def _finish(self, sweep):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        entry = np.array([(sweep.index, sweep.startTime, bool(sweep.fields.get('sweepUp', True)), sweep.offset)], dtype=indexDtype)
+        self.idx.write(entry.tobytes())
+        self.idx.flush()
+        self.current = None
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+        self.f.close()
+        self.idx.close()
+
+class sessionSweep:
+    def __init__(self, session, index, fields, nColumns):
+        self.session = session
+        self.index = index
+        self.fields = fields
+        self.nColumns = nColumns
+        self.columns = fields.get('columns') #only keep as many columns as there are names for
+        if self.columns is not None:
+            self.nColumns = len(self.columns)
+        self.path = session.path
+        self.stem = session.stem+'_{0:d}'.format(index) #for files that go with this sweep
+        self.rows = 0
+        self.startTime = time.time()
+        f = session.f
+        f.seek(0, 2)
+        self.offset = f.tell()
+        settings = json.dumps(fields).encode('utf-8')
+        f.write(recordHeader.pack(magic, index, self.startTime, self.nColumns, len(settings), 0))
+        f.write(settings)
+        f.flush()
+
+    def append(self, block):
+        if len(block) == 0:
+            return
+        block = np.asarray(block)[:,:self.nColumns]
+        f = self.session.f
+        f.seek(0, 2)
+        f.write(np.ascontiguousarray(block, dtype='<f4').tobytes())
+        self.rows = self.rows + len(block)
+        f.seek(self.offset + rowsOffset) #keep the row count current so a crash loses nothing
+        f.write(struct.pack('<Q', self.rows))
+        f.flush()
+
+    def close(self):
+        if self.session.current is self:
+            self.session._finish(self)
+
+#read one record's header and settings starting at offset, returns (fields, where its data starts, nColumns, nRows)
+def _readRecord(f, offset):
+    f.seek(offset)
+    raw = f.read(recordHeader.size)
+    if len(raw) < recordHeader.size:
+        raise ValueError('Truncated record at {0:d}'.format(offset))
+    m, index, startTime, nColumns, settingsLength, nRows = recordHeader.unpack(raw)
+    if m != magic:
+        raise ValueError('No sweep record at {0:d}'.format(offset))
+    fields = json.loads(f.read(settingsLength).decode('utf-8'), object_pairs_hook=OrderedDict)
+    fields['index'] = index
+    fields['startTime'] = startTime
+    fields['nSamples'] = nRows
+    return fields, offset + recordHeader.size + settingsLength, nColumns, nRows
+
+class sessionReader:
+    def __init__(self, path):
+        self.path = path
+        self.refresh()
+
+    #pick up sweeps finished since we last looked (the session might still be being written)
+    def refresh(self):
+        self.index = np.fromfile(self.path + '.idx', dtype=indexDtype)
+
+    def __len__(self):
+        return len(self.index)
+
+    #header fields and data of the sweep with this index
+    def sweep(self, i):
+        with open(self.path, 'rb') as f:
+            fields, dataOffset, nColumns, nRows = _readRecord(f, int(self.index[i]['offset']))
+        if nRows == 0:
+            return fields, np.zeros((0, nColumns), dtype='<f4')
+        return fields, np.memmap(self.path, dtype='<f4', mode='r', offset=dataOffset, shape=(nRows, nColumns))
+
+    #the last sweep started at or before unix time t
+    def sweepAt(self, t):
+        i = np.searchsorted(self.index['startTime'], t, side='right') - 1
+        if i < 0:
+            raise KeyError('Session starts after {0:f}'.format(t))
+        return self.sweep(i)
+
+    #indices of the sweeps started between t0 and t1
+    def sweepsBetween(self, t0, t1):
+        times = self.index['startTime']
+        return range(np.searchsorted(times, t0, side='left'), np.searchsorted(times, t1, side='right'))
+
+#walk every record in a session file and write its index from scratch, returns the number of sweeps found
+def rebuildIndex(path):
+    entries = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        offset = 0
+        while offset < size:
+            try:
+                fields, dataOffset, nColumns, nRows = _readRecord(f, offset)
+            except ValueError:
+                break
+            entries.append((fields['index'], fields['startTime'], bool(fields.get('sweepUp', True)), offset))
+            offset = dataOffset + nRows*nColumns*4
+    np.array(entries, dtype=indexDtype).tofile(path + '.idx')
+    return len(entries)
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+here we have the steady state detector for intelligent advance sweeps
+
+instead of dwelling a fixed dt at every point, the sweep moves on as soon as the sensed value has stopped changing.
+the reader thread feeds every block of readings it saves into a settlingDetector and the sweep thread waits on it
+after each step:
+detector = settlingDetector(column=1, minDwell=0.05, maxDwell=dt) #column 1 is current, what's sensed when sourcing voltage
+detector.newStep() #just before the new setpoint goes out
+detector.update(block) #reader thread, rows of voltage, current, time, status
+dwell, settled = detector.wait() #sweep thread, returns after minDwell once settled, or at maxDwell regardless
+
+a step counts as settled when a straight line fit to the last window seconds of readings (by the instrument's time
+stamps) says the reading would change by less than tolerance (relative, plus floor absolute) over a window. the
+window shrinks to windowFraction of maxDwell for short dwells, so a step can still settle before maxDwell, but there
+have to be minSamples readings in it either way. the first skipReadings readings after a step are ignored, they
+could have been requested before the step went out
+"""
+import time
+import threading
+import numpy as np
+from timing import monotonic
+
+class settlingDetector:
+    window = 0.2 #seconds of readings the slope is fit to (at most)
+    windowFraction = 0.5 #and at most this fraction of maxDwell
+    tolerance = 0.002 #settled when the slope would change the reading by less than this fraction of it over a window
+    floor = 1e-9 #and this much absolute (A or V), so readings near zero can settle too
+    minSamples = 5 #fewer readings than this in a window isn't enough to judge
+    skipReadings = 6 #readings requested before the step could still come after it, set this to the pipeline depth
+
+    def __init__(self, column=1, minDwell=0.05, maxDwell=1.0):
+        self.column = column #which column of the readings to watch
+        self.minDwell = min(minDwell, maxDwell) #seconds
+        self.maxDwell = maxDwell
+        self.span = min(self.window, self.windowFraction*maxDwell) #the window this detector fits to
+        self.lock = threading.Lock()
+        self.settled = threading.Event()
+        self.newStep()
+
+    #forget the readings from the last step
+    def newStep(self):
+        with self.lock:
+            self.settled.clear()
+            self.t = np.empty(0)
+            self.y = np.empty(0)
+            self.firstTime = None
+            self.toSkip = self.skipReadings
+            self.slope = None
+
+    def update(self, block):
+        if len(block) == 0 or self.settled.is_set():
+            return
+        with self.lock:
+            if self.toSkip >= len(block):
+                self.toSkip = self.toSkip - len(block)
+                return
+            block = block[self.toSkip:]
+            self.toSkip = 0
+            t = np.concatenate((self.t, np.asarray(block[:,2], dtype=float)))
+            y = np.concatenate((self.y, np.asarray(block[:,self.column], dtype=float)))
+            if self.firstTime is None:
+                self.firstTime = t[0]
+            keep = t >= t[-1] - self.span
+            self.t, self.y = t[keep], y[keep]
+            if len(self.t) < self.minSamples or t[-1] - self.firstTime < self.span:
+                return
+            dt = self.t - self.t.mean()
+            if not np.any(dt):
+                return
+            self.slope = np.dot(dt, self.y - self.y.mean())/np.dot(dt, dt)
+            if abs(self.slope)*self.span <= self.tolerance*abs(self.y.mean()) + self.floor:
+                self.settled.set()
+
+    #block until the step is over, returns how long it dwelt (seconds) and whether it settled
+    def wait(self):
+        start = monotonic()
+        time.sleep(self.minDwell)
+        settled = self.settled.wait(max(self.maxDwell - (monotonic() - start), 0))
+        return monotonic() - start, bool(settled)
@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""
+here we have a simulated keithley 2400 sourcemeter
+
+it understands the (small) part of the 2400 command set that i-v-vs-time-taker uses and it looks like a pyvisa 1.4
+instrument object (write, read, read_raw, read_values, ask, clear, close) so the gpib class can use it in place of a
+real instrument. this lets the whole acquisition pipeline be exercised and timed without any hardware on a bus
+
+the gpib class picks this backend when the location string starts with SIM
+optional settings can be tacked onto the end of the location string as key=value pairs:
+from gpib import gpib
+k = gpib('SIM::2400::latency=0.002::tau=0.05',useQueues=True)
+
+the settings are:
+latency -- time in seconds that one bus read transaction takes
+readingOverhead -- time in seconds the instrument spends on each reading on top of the integration time from nplcycles
+lineFrequency -- mains frequency in Hz used to turn nplcycles into an integration time
+tau -- time constant in seconds with which the device responds to a source change (0 for an instantaneous response)
+noise -- standard deviation of the gaussian noise added to every sensed value, relative to that value
+iph -- photocurrent of the simulated solar cell in A
+i0 -- diode saturation current in A
+n -- diode ideality factor
+rsh -- shunt resistance in ohms
+
+like the real 2400 in 488.1 mode, addressing the instrument to talk with no query response pending triggers a reading
+"""
+import time
+import math
+import random
+import struct
+
+#the simulated device is a solar cell: an ideal diode with a photocurrent and a shunt resistance
+#currents follow the keithley convention (positive into the HI terminal) so an illuminated cell gives negative current between 0V and Voc
+class diodeModel:
+    vt = 0.025852 #thermal voltage at 300K
+
+    def __init__(self, iph=0.002, i0=1e-12, n=1.5, rsh=1e4):
+        self.iph = iph
+        self.i0 = i0
+        self.n = n
+        self.rsh = rsh
+
+    def current(self, voltage):
+        exponent = min(voltage/(self.n*self.vt), 200) #keep exp from overflowing way past compliance
+        return self.i0*(math.exp(exponent)-1) + voltage/self.rsh - self.iph
+
+    #invert the diode equation with bisection (current is monotonic in voltage) for current source mode
+    def voltage(self, current, vMin=-21.0, vMax=21.0):
+        for i in range(100):
+            vMid = (vMin + vMax)/2
+            if self.current(vMid) < current:
+                vMin = vMid
+            else:
+                vMax = vMid
+        return (vMin + vMax)/2
+
+class simKeithley:
+    statusCompliance = 8 #compliance bit in the 2400's status word
+
+    def __init__(self, locationString='SIM', timeout=None, chunk_size=20*1024, delay=0, values_format=None):
+        self.locationString = locationString
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.delay = delay
+        self.values_format = values_format
+
+        self.latency = 0.006 #with the reading time this gives ~150Hz in fast mode, about what a real 2400 manages over gpib
+        self.readingOverhead = 0.0005 #buffered readings in fast mode come at ~1.5kHz
+        self.lineFrequency = 60.0
+        self.tau = 0.0
+        self.noise = 0.0
+        deviceSettings = {}
+        for option in locationString.split('::')[1:]:
+            if '=' in option:
+                key, value = option.split('=',1)
+                key = key.strip()
+                if key in ('iph','i0','n','rsh'):
+                    deviceSettings[key] = float(value)
+                elif hasattr(self, key):
+                    setattr(self, key, float(value))
+        self.device = diodeModel(**deviceSettings)
+
+        self.t0 = time.time() #instrument time stamps are relative to this
+        self.ttl = 15
+        self.reset()
+
+    #put the simulated instrument into its *rst state
+    def reset(self):
+        self.sourceFunction = 'voltage'
+        self.sourceLevel = {'voltage': 0.0, 'current': 0.0}
+        self.sourceMode = 'fixed'
+        self.sweepStart = {'voltage': 0.0, 'current': 0.0}
+        self.sweepStop = {'voltage': 0.0, 'current': 0.0}
+        self.sweepPoints = 2500
+        self.sourceList = {'voltage': [], 'current': []}
+        self.sourceDelay = 0.001
+        self.protection = {'current': 1.05e-4, 'voltage': 21.0}
+        self.nplc = 1.0
+        self.averageCount = 1
+        self.averaging = False
+        self.triggerCount = 1
+        self.armCount = 1
+        self.armSource = 'immediate'
+        self.armTimer = 0.1
+        self.outputOn = False
+        self.dataFormat = 'ascii'
+        self.elements = ['voltage', 'current', 'resistance', 'time', 'status']
+        self.traceFeed = 'sense'
+        self.traceControl = 'never'
+        self.tracePoints = 100
+        self.traceBuffer = []
+        self.errors = []
+        self.response = None
+
+        #the device's sensed value relaxes towards its steady state value with time constant tau
+        self.lastSensed = 0.0
+        self.lastSensedTime = time.time()
+
+    #expand a SCPI header to the long form of each of its nodes so that short and long forms look the same
+    def _normalize(self, header):
+        longForms = {'sour': 'source', 'sens': 'sense', 'func': 'function', 'volt': 'voltage', 'curr': 'current',
+                     'trig': 'trigger', 'coun': 'count', 'outp': 'output', 'form': 'format', 'elem': 'elements',
+                     'trac': 'trace', 'cont': 'control', 'poin': 'points', 'prot': 'protection', 'aver': 'average',
+                     'nplc': 'nplcycles', 'syst': 'system', 'del': 'delay', 'swe': 'sweep', 'init': 'initiate',
+                     'stat': 'state', 'rang': 'range', 'star': 'start', 'disp': 'display', 'clea': 'clear',
+                     'tim': 'timer', 'lfr': 'lfrequency'}
+        nodes = []
+        for node in header.strip().lstrip(':').lower().split(':'):
+            nodes.append(longForms.get(node, node))
+        return ':'.join(nodes)
+
+    def write(self, message):
+        for command in message.split(';'):
+            command = command.strip()
+            if command:
+                self._command(command)
+
+    def _command(self, command):
+        parts = command.split(None, 1)
+        header = self._normalize(parts[0])
+        argument = parts[1].strip().strip('"').lower() if len(parts) > 1 else ''
+        nodes = header.split(':')
+
+        if header == '*rst':
+            self.reset()
+        elif header == '*cls':
+            self.errors = []
+        elif header == '*idn?':
+            self.response = 'KEITHLEY INSTRUMENTS INC.,MODEL 2400,0000000,C33   Mar 31 2015 09:32:39/A02  /K/J (SIMULATED)'
+        elif header == 'system:mep:state?':
+            self.response = '0' #488.1 protocol
+        elif header == 'system:error?':
+            self.response = self.errors.pop(0) if self.errors else '0,"No error"'
+        elif header == 'source2:ttl:actual?':
+            self.response = str(self.ttl)
+        elif header == 'source2:ttl':
+            self.ttl = int(float(argument))
+        elif header == 'format:data':
+            self.dataFormat = 'sreal' if argument.startswith('sre') else 'ascii'
+        elif header == 'format:elements':
+            self.elements = [self._normalize(e) for e in argument.split(',')]
+        elif header == 'source:function':
+            self.sourceFunction = self._normalize(argument)
+        elif header in ('source:voltage', 'source:current', 'source:voltage:level', 'source:current:level'):
+            self.sourceLevel[nodes[1]] = float(argument)
+        elif header in ('source:voltage:mode', 'source:current:mode'):
+            self.sourceMode = {'fix': 'fixed', 'swe': 'sweep'}.get(argument[:3], argument)
+        elif header in ('source:voltage:start', 'source:current:start'):
+            self.sweepStart[nodes[1]] = float(argument)
+        elif header in ('source:voltage:stop', 'source:current:stop'):
+            self.sweepStop[nodes[1]] = float(argument)
+        elif header == 'source:sweep:points':
+            self.sweepPoints = int(float(argument))
+        elif header in ('source:list:voltage', 'source:list:current'):
+            self.sourceList[nodes[2]] = [float(x) for x in argument.split(',')]
+        elif header in ('source:list:voltage:append', 'source:list:current:append'):
+            self.sourceList[nodes[2]] += [float(x) for x in argument.split(',')]
+        elif header == 'source:delay':
+            self.sourceDelay = float(argument)
+        elif header in ('sense:current:protection', 'sense:voltage:protection'):
+            self.protection[nodes[1]] = float(argument)
+        elif header in ('sense:current:nplcycles', 'sense:voltage:nplcycles'):
+            self.nplc = float(argument)
+        elif header == 'sense:average':
+            self.averaging = argument in ('on', '1')
+        elif header == 'sense:average:count':
+            self.averageCount = int(float(argument))
+        elif header == 'trigger:count':
+            self.triggerCount = int(float(argument))
+        elif header == 'arm:count':
+            self.armCount = int(float(argument))
+        elif header == 'arm:source':
+            self.armSource = 'timer' if argument.startswith('tim') else 'immediate'
+        elif header == 'arm:timer':
+            self.armTimer = float(argument)
+        elif header == 'system:lfrequency?':
+            self.response = '{0:g}'.format(self.lineFrequency)
+        elif header in ('output', 'output:state'):
+            self.outputOn = argument in ('on', '1')
+        elif header == 'trace:feed':
+            self.traceFeed = argument
+        elif header == 'trace:feed:control':
+            self.traceControl = 'next' if argument.startswith('next') else 'never'
+        elif header == 'trace:points':
+            self.tracePoints = int(float(argument))
+        elif header == 'trace:clear':
+            self.traceBuffer = []
+        elif header == 'trace:data?':
+            self.response = self._format(self.traceBuffer)
+        elif header == 'initiate':
+            self._runTrigger()
+        elif header == 'read?':
+            self.response = self._format(self._runTrigger())
+        elif header.endswith('?'):
+            self.response = '0'
+        elif nodes[0] in ('source', 'sense', 'system', 'display', 'route', 'trigger', 'arm', 'format', 'trace', 'abort'):
+            pass #accepted, but has no effect on the simulation
+        else:
+            self.errors.append('-113,"Undefined header"')
+
+    #the value the device presents at its terminals right now for the given source setting
+    def _sense(self, sourceValue):
+        if self.sourceFunction == 'voltage':
+            steady = self.device.current(sourceValue)
+        else:
+            steady = self.device.voltage(sourceValue)
+        now = time.time()
+        if self.tau > 0:
+            sensed = steady + (self.lastSensed - steady)*math.exp(-(now - self.lastSensedTime)/self.tau)
+        else:
+            sensed = steady
+        self.lastSensed = sensed
+        self.lastSensedTime = now
+        if self.noise > 0:
+            sensed = sensed + random.gauss(0, abs(sensed)*self.noise)
+        return sensed
+
+    #do one source-delay-measure cycle and return the reading as a dict of elements
+    def _measure(self, sourceValue):
+        time.sleep(self.sourceDelay + self.readingOverhead + self.nplc/self.lineFrequency*(self.averageCount if self.averaging else 1))
+        status = 0
+        if not self.outputOn:
+            voltage = current = 0.0
+        elif self.sourceFunction == 'voltage':
+            voltage = sourceValue
+            current = self._sense(sourceValue)
+            limit = self.protection['current']
+            if abs(current) > limit:
+                current = math.copysign(limit, current)
+                status = status | self.statusCompliance
+        else:
+            current = sourceValue
+            voltage = self._sense(sourceValue)
+            limit = self.protection['voltage']
+            if abs(voltage) > limit:
+                voltage = math.copysign(limit, voltage)
+                status = status | self.statusCompliance
+        return {'voltage': voltage, 'current': current, 'resistance': 9.91e37, 'time': time.time() - self.t0, 'status': float(status)}
+
+    #the source values visited by one run through the trigger model
+    def _sourceValues(self):
+        function = self.sourceFunction
+        if self.sourceMode == 'sweep':
+            start = self.sweepStart[function]
+            stop = self.sweepStop[function]
+            nPoints = self.sweepPoints
+            if nPoints > 1:
+                points = [start + (stop - start)*i/float(nPoints - 1) for i in range(nPoints)]
+            else:
+                points = [start]
+            return [points[i % len(points)] for i in range(self.armCount*self.triggerCount)]
+        elif self.sourceMode == 'list':
+            points = self.sourceList[function] or [self.sourceLevel[function]]
+            return [points[i % len(points)] for i in range(self.armCount*self.triggerCount)]
+        else:
+            return [self.sourceLevel[function]]*(self.armCount*self.triggerCount)
+
+    #run the trigger model: take arm count times trigger count readings, feeding the trace buffer if it's enabled.
+    #with the arm timer, the first pass through the arm layer is immediate and each one after it waits for the next
+    #tick of the timer (or goes straight away if the readings already took longer than that)
+    def _runTrigger(self):
+        readings = []
+        start = time.time()
+        for i, value in enumerate(self._sourceValues()):
+            if self.armSource == 'timer' and i > 0 and i % self.triggerCount == 0:
+                wait = start + i//self.triggerCount*self.armTimer - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+            readings.append(self._measure(value))
+        if self.traceControl == 'next':
+            room = self.tracePoints - len(self.traceBuffer)
+            self.traceBuffer = self.traceBuffer + readings[:room]
+            if len(self.traceBuffer) >= self.tracePoints:
+                self.traceControl = 'never' #the 2400 stops feeding the buffer once it's full
+        return readings
+
+    #turn readings into what the 2400 would put on the bus for the current :format settings
+    def _format(self, readings):
+        #like the 2400, elements always come out in this order no matter how they were listed in :format:elements
+        elements = [e for e in ('voltage', 'current', 'resistance', 'time', 'status') if e in self.elements]
+        values = []
+        for reading in readings:
+            values = values + [reading[element] for element in elements]
+        if self.dataFormat == 'sreal':
+            return b'#0' + struct.pack('>{0}f'.format(len(values)), *values) + b'\n'
+        else:
+            return ','.join(['{0:+.6E}'.format(value) for value in values]) + '\n'
+
+    def read_raw(self):
+        time.sleep(self.latency)
+        if self.response is None:
+            self.response = self._format(self._runTrigger()) #talk addressing triggers a reading in 488.1 mode
+        response = self.response
+        self.response = None
+        return response
+
+    #binary (sreal) responses are bytes, ascii ones are str
+    def read(self):
+        response = self.read_raw()
+        return response.rstrip(b'\r\n' if isinstance(response, bytes) else '\r\n')
+
+    def read_values(self, format=None):
+        response = self.read()
+        if isinstance(response, bytes) and response.startswith(b'#0'):
+            body = response[2:]
+            nValues = len(body)//4
+            return list(struct.unpack('>{0}f'.format(nValues), body[:nValues*4]))
+        else:
+            return [float(x) for x in response.split(',')]
+
+    def ask(self, message):
+        self.write(message)
+        return self.read()
+
+    def ask_for_values(self, message, format=None):
+        self.write(message)
+        return self.read_values(format)
+
+    def clear(self):
+        self.response = None
+
+    def trigger(self):
+        self._runTrigger()
+
+    def close(self):
+        pass
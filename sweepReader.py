@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+"""
+here we have code for reading back the sweeps this program saves
+
+sweepIndex scans a directory of output files (.csv, .npy with its .json sidecar and .session files) and keeps a
+summary of every sweep in it: file, sweep index within a session, timestamp, device (the file name prefix typed
+into the gui), area, mode, direction, number of samples, raw max power and the figures of merit (Voc, Isc, FF, PCE...)
+from the _fom.json saved with it, if there is one. the summaries are cached in
+.sweepIndex.json in that directory and a file is only read again when its modification time or size changes, so
+after the first scan looking things up doesn't touch the data at all:
+index = sweepIndex('/data')
+for entry in index.query(device='cell1', since=time.time()-3600):
+    fields, data = loadSweep(entry)
+
+loadSweep also takes a file name. csv data gets parsed in one go with np.fromstring (much faster than np.loadtxt),
+.npy files and session sweeps come back memory mapped
+"""
+import os
+import re
+import json
+import numpy as np
+from collections import OrderedDict
+from sessionStore import sessionReader
+from dataWriters import sweepColumns
+
+cacheName = '.sweepIndex.json'
+stampPattern = re.compile(r'^(.*)_(\d+)\.(csv|npy|session)$') #<device>_<unix time>.<ext>
+sidecarSuffixes = ('_mpp.csv', '_steps.csv', '_transients.csv') #saved alongside the sweeps but they aren't sweeps
+sweepLayouts = [sweepColumns(False)[1], sweepColumns(True)[1]] #the column headers a sweep file can have
+
+#header lines of our csv files look like '# Area = 0.12 [cm^2]', turn them into the fields a .npy sidecar holds
+def _parseCsvHeader(lines):
+    fields = OrderedDict()
+    for line in lines:
+        line = line.lstrip('#').strip()
+        if line.startswith('Area ='):
+            fields['Area [cm^2]'] = line[len('Area ='):].replace('[cm^2]', '').strip()
+        elif line.startswith('I&V vs t ='):
+            fields['I&V vs t'] = line.split('=')[1].strip() == '1'
+        elif line.startswith('sweepUp ='):
+            fields['sweepUp'] = line.split('=')[1].strip() == '1'
+        elif line.startswith('Voltage'):
+            fields['columns'] = line.split(',')
+    return fields
+
+def _loadCsv(path):
+    with open(path, 'r') as f:
+        text = f.read()
+    headerLines = []
+    start = 0
+    while text.startswith('#', start): #split off the comment header
+        end = text.find('\n', start)
+        end = len(text) if end < 0 else end + 1
+        headerLines.append(text[start:end])
+        start = end
+    fields = _parseCsvHeader(headerLines)
+    columns = [column.strip() for column in fields.get('columns', [])]
+    if 'Area [cm^2]' not in fields or columns not in sweepLayouts:
+        raise ValueError('{0:s} is not a sweep file'.format(path))
+    fields['columns'] = columns
+    nColumns = len(columns)
+    end = text.find('\n', start)
+    firstRow = text[start:end if end >= 0 else len(text)]
+    if firstRow.strip() and firstRow.count(',') != nColumns - 1:
+        raise ValueError('{0:s} has {1:d} columns of data, its header says {2:d}'.format(path, firstRow.count(',') + 1, nColumns))
+    data = np.fromstring(text[start:].replace('\n', ','), sep=',')
+    return fields, data[:len(data)//nColumns*nColumns].reshape((-1, nColumns))
+
+def _loadNpy(path):
+    with open(path + '.json', 'r') as f:
+        fields = json.load(f, object_pairs_hook=OrderedDict)
+    return fields, np.load(path, mmap_mode='r')
+
+#fields and data of a sweep, from an index entry or a file name (a session entry needs the sweep index too)
+def loadSweep(entry, sweep=None):
+    if isinstance(entry, dict):
+        path, sweep = entry['path'], entry.get('sweep')
+    else:
+        path = entry
+    if path.endswith('.session'):
+        return sessionReader(path).sweep(sweep)
+    elif path.endswith('.npy'):
+        return _loadNpy(path)
+    else:
+        return _loadCsv(path)
+
+#the figures of merit saved next to a sweep, None if there aren't any
+def _figuresOfMerit(stem):
+    try:
+        with open(stem + '_fom.json', 'r') as f:
+            return json.load(f, object_pairs_hook=OrderedDict)
+    except (IOError, ValueError):
+        return None
+
+def _summary(path, fields, data):
+    m = stampPattern.match(os.path.basename(path))
+    entry = {'path': path,
+             'device': m.group(1) if m else os.path.splitext(os.path.basename(path))[0],
+             'timestamp': float(m.group(2)) if m else os.path.getmtime(path),
+             'area': fields.get('Area [cm^2]'),
+             'saveTime': fields.get('I&V vs t'),
+             'sweepUp': fields.get('sweepUp'),
+             'nSamples': len(data),
+             'pMaxRaw': float(np.max(data[:,0]*data[:,1])) if len(data) > 0 else None}
+    stem = os.path.splitext(path)[0]
+    if 'startTime' in fields: #session sweeps know exactly when they started
+        entry['timestamp'] = fields['startTime']
+        entry['sweep'] = fields['index']
+        stem = stem + '_{0:d}'.format(fields['index'])
+    entry['fom'] = _figuresOfMerit(stem)
+    return entry
+
+#index entries for everything in one file, [] if it isn't one of ours
+def _scanFile(path):
+    try:
+        if path.endswith('.session'):
+            reader = sessionReader(path)
+            entries = []
+            for i in range(len(reader)):
+                fields, data = reader.sweep(i)
+                entries.append(_summary(path, fields, data))
+            return entries
+        else:
+            fields, data = loadSweep(path)
+            return [_summary(path, fields, data)]
+    except (IOError, ValueError, KeyError):
+        return []
+
+class sweepIndex:
+    def __init__(self, directory):
+        self.directory = directory
+        self.cachePath = os.path.join(directory, cacheName)
+        self.files = {} #file name: {'mtime':, 'size':, 'entries': []}
+        try:
+            with open(self.cachePath, 'r') as f:
+                self.files = json.load(f)
+        except (IOError, ValueError):
+            pass
+        self.update()
+
+    #look at the directory again and read whatever's new or changed since the last time
+    def update(self):
+        changed = False
+        names = set()
+        listing = os.listdir(self.directory)
+        #figures of merit get saved just after the data, as <stem>_fom.json or <session stem>_<sweep index>_fom.json
+        foms = {} #data file stem or session file name: [fom file names]
+        for name in listing:
+            if name.endswith('_fom.json'):
+                stem = name[:-len('_fom.json')]
+                foms.setdefault(stem, []).append(name)
+                sessionStem, sep, index = stem.rpartition('_')
+                if sep and index.isdigit():
+                    foms.setdefault(sessionStem + '.session', []).append(name)
+        for name in listing:
+            if not (name.endswith('.csv') or name.endswith('.npy') or name.endswith('.session')) or name.endswith(sidecarSuffixes):
+                continue
+            path = os.path.join(self.directory, name)
+            mtime, size = os.path.getmtime(path), os.path.getsize(path)
+            if name.endswith('.session') and os.path.exists(path + '.idx'): #a sweep only counts once it's in the index
+                mtime, size = max(mtime, os.path.getmtime(path + '.idx')), size + os.path.getsize(path + '.idx')
+            for fom in foms.get(name if name.endswith('.session') else os.path.splitext(name)[0], []):
+                fomPath = os.path.join(self.directory, fom)
+                mtime, size = max(mtime, os.path.getmtime(fomPath)), size + os.path.getsize(fomPath)
+            names.add(name)
+            cached = self.files.get(name)
+            if cached is not None and cached['mtime'] == mtime and cached['size'] == size:
+                continue
+            self.files[name] = {'mtime': mtime, 'size': size, 'entries': _scanFile(path)}
+            changed = True
+        for name in list(self.files.keys()): #forget files that are gone
+            if name not in names:
+                del self.files[name]
+                changed = True
+        self.entries = sorted([e for f in self.files.values() for e in f['entries']], key=lambda e: e['timestamp'])
+        if changed:
+            try:
+                with open(self.cachePath + '.part', 'w') as f:
+                    json.dump(self.files, f)
+                if os.path.exists(self.cachePath):
+                    os.remove(self.cachePath)
+                os.rename(self.cachePath + '.part', self.cachePath)
+            except (IOError, OSError): #read only directory, we just won't have a cache
+                pass
+
+    #entries (sorted by time) matching everything that's given, device is the file name prefix
+    def query(self, device=None, since=None, until=None, saveTime=None, sweepUp=None):
+        found = []
+        for e in self.entries:
+            if device is not None and e['device'] != device:
+                continue
+            if since is not None and e['timestamp'] < since:
+                continue
+            if until is not None and e['timestamp'] > until:
+                continue
+            if saveTime is not None and e['saveTime'] != saveTime:
+                continue
+            if sweepUp is not None and e['sweepUp'] != sweepUp:
+                continue
+            found.append(e)
+        return found
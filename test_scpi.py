@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+here we have tests for scpi.py, run them with python -m unittest test_scpi
+"""
+import unittest
+from scpi import shortHeader, coalesce, shadowState
+
+class coalesceTests(unittest.TestCase):
+    def test_displayTextWritesAreKept(self):
+        commands = [':display:window:text:data "first"', ':display:window:text:data "second"']
+        self.assertEqual(coalesce(commands), [';'.join(commands)])
+
+    def test_shortFormDisplayTextWritesAreKept(self):
+        commands = [':DISP:WIND2:TEXT:DATA "first"', ':DISP:WIND2:TEXT:DATA "second"']
+        self.assertEqual(coalesce(commands), [';'.join(commands)])
+
+    def test_supersededSettingIsDropped(self):
+        self.assertEqual(coalesce([':sense:current:nplcycles 1', ':SENS:CURR:NPLC 0.01']), [':SENS:CURR:NPLC 0.01'])
+
+    def test_functionModeIsABarrier(self):
+        commands = [':source:voltage:mode fixed', ':source:function:mode voltage', ':source:voltage:mode list']
+        self.assertEqual(coalesce(commands), [';'.join(commands)])
+
+class shadowStateTests(unittest.TestCase):
+    def test_displayTextIsNotRemembered(self):
+        shadow = shadowState()
+        shadow.record(':display:window:text:data "hello"')
+        self.assertFalse(shadow.isCurrent(':display:window:text:data "hello"'))
+
+    def test_repeatedSettingIsCurrent(self):
+        shadow = shadowState()
+        shadow.record(':sense:current:nplcycles 0.01')
+        self.assertTrue(shadow.isCurrent(':SENS:CURR:NPLC 0.010'))
+
+class shortHeaderTests(unittest.TestCase):
+    def test_longAndShortFormsMatch(self):
+        self.assertEqual(shortHeader(':SOURce:VOLTage:STARt 1'), shortHeader(':sour:volt:star 0.5'))
+        self.assertEqual(shortHeader(':display:window:text:data "x"'), 'disp:wind:text:data')
+
+    def test_shortNodesAreTheirOwnShortForm(self):
+        self.assertEqual(shortHeader(':trace:data?'), 'trac:data?')
+        self.assertEqual(shortHeader(':source:list:voltage 0.1,0.2'), 'sour:list:volt')
+        self.assertEqual(shortHeader(':source:function:mode voltage'), 'sour:func:mode')
+
+if __name__ == '__main__':
+    unittest.main()
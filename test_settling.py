@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""
+here we have tests for settling.py, run them with python -m unittest test_settling
+"""
+import unittest
+import numpy as np
+from settling import settlingDetector
+
+#rows of voltage, current, time, status for a step to 1 mA that settles with time constant tau
+def stepReadings(rate, duration, tau=0.0005):
+    t = np.arange(0, duration, 1.0/rate)
+    current = 1e-3*(1 - np.exp(-t/tau))
+    return np.column_stack((np.full(len(t), 0.5), current, t, np.zeros(len(t))))
+
+#feed readings in one at a time, returns the time stamp of the one that settled the step (None if none did)
+def settledAt(detector, readings):
+    for row in readings:
+        detector.update(row[np.newaxis,:])
+        if detector.settled.is_set():
+            return row[2]
+    return None
+
+class settlingTests(unittest.TestCase):
+    def test_fastStepSettlesBeforeShortMaxDwell(self):
+        detector = settlingDetector(column=1, minDwell=0.05, maxDwell=0.02)
+        detector.skipReadings = 2
+        t = settledAt(detector, stepReadings(1000, 0.02))
+        self.assertIsNotNone(t)
+        self.assertLess(t, 0.02)
+
+    def test_minDwellIsCappedAtMaxDwell(self):
+        detector = settlingDetector(column=1, minDwell=0.05, maxDwell=0.02)
+        detector.update(stepReadings(1000, 0.02))
+        dwell, settled = detector.wait()
+        self.assertTrue(settled)
+        self.assertLess(dwell, 0.05)
+
+    def test_longMaxDwellKeepsTheFullWindow(self):
+        detector = settlingDetector(column=1, minDwell=0.05, maxDwell=2.0)
+        t = settledAt(detector, stepReadings(1000, 1.0))
+        self.assertGreaterEqual(t, settlingDetector.window)
+
+    def test_tooFewReadingsNeverSettle(self):
+        detector = settlingDetector(column=1, minDwell=0.01, maxDwell=0.02)
+        detector.skipReadings = 0
+        self.assertIsNone(settledAt(detector, stepReadings(200, 0.02)))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""
+here we have timing helpers for software paced sweeps
+
+monotonic() is a clock that never jumps (python 2 doesn't have time.monotonic so we find one ourselves)
+deadlineScheduler paces a sequence of events at fixed intervals against absolute deadlines from that clock, so
+sleep overshoot and the time spent issuing each step don't accumulate over thousands of points like they do with
+time.sleep(dt) after every step:
+schedule = deadlineScheduler(0.1)
+schedule.start()
+for i, point in enumerate(points):
+    schedule.waitFor(i)
+    doTheThing(point)
+    schedule.record(i, point)
+schedule.log then holds (setpoint, scheduled time, actual time) for every step, in seconds from start()
+"""
+import sys
+import time
+import ctypes
+import ctypes.util
+
+def _findMonotonic():
+    if hasattr(time, 'monotonic'): #python 3
+        return time.monotonic
+    if sys.platform == 'win32': #time.clock is the performance counter here, it's monotonic and high resolution
+        return time.clock
+    try:
+        class timespec(ctypes.Structure):
+            _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        clock_gettime = libc.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        clockId = 6 if sys.platform == 'darwin' else 1 #CLOCK_MONOTONIC
+        def monotonic():
+            t = timespec()
+            clock_gettime(clockId, ctypes.byref(t))
+            return t.tv_sec + t.tv_nsec*1e-9
+        monotonic()
+        return monotonic
+    except Exception:
+        return time.time #better than nothing
+
+monotonic = _findMonotonic()
+
+class deadlineScheduler:
+    def __init__(self, dt):
+        self.dt = dt
+        self.oversleep = 0.001 #running estimate of how late the OS wakes us from sleep, we wake up this much early
+        self.log = []
+
+    def start(self):
+        self.t0 = monotonic()
+        self.log = []
+
+    #seconds since start()
+    def now(self):
+        return monotonic() - self.t0
+
+    #block until the deadline for step i (i*dt after start), returns how late we actually were
+    def waitFor(self, i):
+        deadline = i*self.dt
+        remaining = deadline - self.now()
+        if remaining > self.oversleep:
+            requested = remaining - self.oversleep
+            before = self.now()
+            time.sleep(requested)
+            overshoot = (self.now() - before) - requested
+            self.oversleep = 0.9*self.oversleep + 0.1*max(overshoot, 0) #learn the scheduler's wakeup latency
+        while self.now() < deadline: #yield until the deadline for the last little bit
+            time.sleep(0)
+        return self.now() - deadline
+
+    #note when step i actually happened
+    def record(self, i, setpoint):
+        self.log.append((setpoint, i*self.dt, self.now()))